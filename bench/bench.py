@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for qemu-backup.py. qemu-img, virsh and the libvirt
+# bindings are replaced by the stand-ins in bench/fake, so no hypervisor is
+# needed and the numbers show the cost of the script itself: wall time and
+# the number of qemu-img and virsh calls for a scan and a backup run on
+# synthetic backup directories of growing chain depth.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+fake_dir = bench_dir + '/fake'
+script = os.path.dirname(bench_dir) + '/qemu-backup.py'
+
+def interval_counts(depth):
+    # split a chain of depth incrementals over daily, weekly and monthly
+    monthly = max(1, depth // 8)
+    weekly = max(1, depth // 4)
+    return [['daily', depth - weekly - monthly], ['weekly', weekly], ['monthly', monthly]]
+
+def write_image(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+def generate(workdir, args, depth):
+    # backup images use the naming scheme of the README, every drive has a
+    # full chain in every backupset and the newest backupset is live
+    backup_dir = workdir + '/backup'
+    live_dir = workdir + '/live'
+    libvirt_dir = workdir + '/libvirt'
+    for path in [backup_dir, live_dir, libvirt_dir]:
+        os.makedirs(path)
+    intervals = interval_counts(depth)
+    for d in range(args.domains):
+        vm_name = 'bench%d' % (d)
+        disks = {}
+        for r in range(args.drives):
+            dev = 'vd' + chr(ord('a') + r)
+            for b in range(1, args.backupsets + 1):
+                prefix = '%s.b%03d.%s' % (vm_name, b, dev)
+                backing = prefix + '.base.img'
+                write_image(backup_dir + '/' + backing, { 'blocks': ['base'] })
+                nr = 0
+                for interval_name, count in reversed(intervals):
+                    for idx in range(count - 1, -1, -1):
+                        nr += 1
+                        image = '%s.i%05d.%s.%d.img' % (prefix, nr, interval_name, idx)
+                        write_image(backup_dir + '/' + image, { 'backing': backing, 'blocks': [image] })
+                        backing = image
+            live = '%s/%s-%s.img' % (live_dir, vm_name, dev)
+            write_image(live, { 'blocks': ['live'] })
+            overlay = '%s.b%03d.i%05d.img' % (live[:-4], args.backupsets, nr + 1)
+            write_image(overlay, { 'backing': live, 'blocks': [] })
+            disks[dev] = overlay
+        write_image('%s/%s.json' % (libvirt_dir, vm_name), { 'disks': disks, 'checkpoints': [] })
+    return ','.join(['%s:%d' % (name, count) for name, count in intervals])
+
+def run(workdir, args, intervals, extra):
+    log = workdir + '/calls.log'
+    if os.path.exists(log):
+        os.unlink(log)
+    env = dict(os.environ)
+    env['PATH'] = fake_dir + os.pathsep + env['PATH']
+    env['PYTHONPATH'] = fake_dir
+    env['FAKE_LIBVIRT_DIR'] = workdir + '/libvirt'
+    env['FAKE_LOG'] = log
+    env['FAKE_AGENT_DELAY'] = str(args.agent_delay)
+    cmd = [sys.executable, script, '--backup-dir', workdir + '/backup', '--intervals', intervals,
+           '--engine', args.engine, '--jobs', str(args.jobs)] + extra + ['bench%d' % (d) for d in range(args.domains)]
+    start = time.monotonic()
+    result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    duration = time.monotonic() - start
+    if result.returncode != 0:
+        raise Exception('qemu-backup failed:\n' + result.stdout)
+    calls = {}
+    if os.path.exists(log):
+        with open(log) as f:
+            for line in f:
+                command = line.split(' ')[0]
+                calls[command] = calls.get(command, 0) + 1
+    return duration, calls
+
+def bench_depth(args, depth):
+    # every scenario runs on a freshly generated tree, the best of
+    # --repeat runs is reported
+    scenarios = [
+        ('scan (cold)', ['--dry-run'], False),
+        ('scan (indexed)', ['--dry-run'], True),
+        ('daily backup', [], True),
+        ('monthly promote', ['--interval', 'monthly'], True)
+    ]
+    results = []
+    for name, extra, indexed in scenarios:
+        best = None
+        for i in range(args.repeat):
+            workdir = tempfile.mkdtemp(prefix='qemu-backup-bench.')
+            try:
+                intervals = generate(workdir, args, depth)
+                if indexed:
+                    run(workdir, args, intervals, ['--dry-run'])
+                duration, calls = run(workdir, args, intervals, extra)
+            finally:
+                shutil.rmtree(workdir)
+            if best is None or duration < best[0]:
+                best = (duration, calls)
+        results.append((name, best[0], best[1]))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark qemu-backup.py against fake qemu-img, virsh and libvirt.')
+    parser.add_argument('--domains', dest='domains', type=int, default=4, help='number of domains (default: 4)')
+    parser.add_argument('--drives', dest='drives', type=int, default=2, help='drives per domain (default: 2)')
+    parser.add_argument('--backupsets', dest='backupsets', type=int, default=2, help='backupsets per drive (default: 2)')
+    parser.add_argument('--depths', dest='depths', default='8,16,32', help='comma separated chain depths, at least 4 (default: 8,16,32)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='runs per scenario, the fastest is reported (default: 3)')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='passed to qemu-backup.py --jobs (default: 1)')
+    parser.add_argument('--engine', dest='engine', choices=['snapshot', 'bitmap'], default='snapshot', help='passed to qemu-backup.py --engine (default: snapshot)')
+    parser.add_argument('--agent-delay', dest='agent_delay', type=float, default=0, help='simulated guest agent latency in seconds (default: 0)')
+    args = parser.parse_args()
+
+    depths = [int(depth) for depth in args.depths.split(',')]
+    if min(depths) < 4:
+        raise ValueError('Chain depth must be at least 4')
+
+    print('%d domains, %d drives, %d backupsets, best of %d' % (args.domains, args.drives, args.backupsets, args.repeat))
+    print('%-6s %-16s %10s %10s %8s' % ('depth', 'scenario', 'seconds', 'qemu-img', 'virsh'))
+    for depth in depths:
+        for name, duration, calls in bench_depth(args, depth):
+            print('%-6d %-16s %10.3f %10d %8d' % (depth, name, duration, calls.get('qemu-img', 0), calls.get('virsh', 0)))
@@ -0,0 +1,149 @@
+# Stand-in for the libvirt python bindings used by the benchmarks. Every
+# domain is a JSON file in $FAKE_LIBVIRT_DIR holding its disks and checkpoints.
+
+import builtins
+import os
+import json
+import time
+import xml.etree.ElementTree as ET
+
+VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA = 4
+VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY = 16
+VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT = 32
+VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE = 64
+VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC = 128
+VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY = 2
+VIR_DOMAIN_JOB_NONE = 0
+VIR_DOMAIN_JOB_COMPLETED = 3
+VIR_DOMAIN_JOB_FAILED = 4
+VIR_DOMAIN_JOB_STATS_COMPLETED = 1
+VIR_DOMAIN_AGENT_RESPONSE_TIMEOUT_DEFAULT = -1
+VIR_ERR_NO_DOMAIN = 42
+
+# simulated duration of guest agent calls in seconds
+agent_delay = float(os.environ.get('FAKE_AGENT_DELAY', '0'))
+
+class libvirtError(Exception):
+    def __init__(self, message, code=1):
+        Exception.__init__(self, message)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+def domain_path(vm_name):
+    return os.environ['FAKE_LIBVIRT_DIR'] + '/' + vm_name + '.json'
+
+def domain_load(vm_name):
+    try:
+        with builtins.open(domain_path(vm_name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise libvirtError('Domain not found: ' + vm_name, VIR_ERR_NO_DOMAIN)
+
+def domain_save(vm_name, domain):
+    with builtins.open(domain_path(vm_name) + '.tmp', 'w') as f:
+        json.dump(domain, f)
+    os.replace(domain_path(vm_name) + '.tmp', domain_path(vm_name))
+
+def image_write(image, data):
+    with builtins.open(image, 'w') as f:
+        json.dump(data, f)
+
+class virDomainSnapshot(object):
+    def delete(self, flags=0):
+        pass
+
+class virDomainCheckpoint(object):
+    def __init__(self, domain, name):
+        self.domain = domain
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def delete(self, flags=0):
+        domain = domain_load(self.domain.name)
+        domain['checkpoints'].remove(self.name)
+        domain_save(self.domain.name, domain)
+
+class virDomain(object):
+    def __init__(self, name):
+        self.name = name
+
+    def XMLDesc(self, flags=0):
+        xml = "<domain><name>%s</name><devices>" % (self.name)
+        for dev, image in domain_load(self.name)['disks'].items():
+            xml += "<disk type='file' device='disk'><driver name='qemu' type='qcow2'/><source file='%s'/><target dev='%s'/></disk>" % (image, dev)
+        return xml + "</devices></domain>"
+
+    def agentSetResponseTimeout(self, timeout, flags=0):
+        return 0
+
+    def fSTrim(self, mountPoint, minimum, flags=0):
+        time.sleep(agent_delay)
+
+    def fsFreeze(self, mountpoints=None, flags=0):
+        time.sleep(agent_delay)
+        return len(mountpoints or []) or 1
+
+    def fsThaw(self, mountpoints=None, flags=0):
+        return len(mountpoints or []) or 1
+
+    def snapshotCreateXML(self, xmlDesc, flags=0):
+        domain = domain_load(self.name)
+        if flags & VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE:
+            time.sleep(agent_delay)
+        for disk in ET.fromstring(xmlDesc).findall('disks/disk'):
+            if disk.get('snapshot') == 'no':
+                continue
+            dev = disk.get('name')
+            if not dev in domain['disks']:
+                dev = [d for d in domain['disks'] if domain['disks'][d] == disk.get('name')][0]
+            image = disk.find('source').get('file')
+            if not flags & VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT:
+                if os.path.exists(image):
+                    raise libvirtError('image ' + image + ' already exists')
+                image_write(image, { 'backing': domain['disks'][dev], 'blocks': [] })
+            domain['disks'][dev] = image
+        domain_save(self.name, domain)
+        return virDomainSnapshot()
+
+    def listAllCheckpoints(self, flags=0):
+        return [virDomainCheckpoint(self, name) for name in domain_load(self.name).get('checkpoints', [])]
+
+    def checkpointLookupByName(self, name, flags=0):
+        if not name in domain_load(self.name).get('checkpoints', []):
+            raise libvirtError('Checkpoint not found: ' + name)
+        return virDomainCheckpoint(self, name)
+
+    def backupBegin(self, backupXML, checkpointXML=None, flags=0):
+        domain = domain_load(self.name)
+        for disk in ET.fromstring(backupXML).findall('disks/disk'):
+            if disk.get('backup') != 'no':
+                image_write(disk.find('target').get('file'), { 'blocks': ['changed'] })
+        if checkpointXML is not None:
+            domain['checkpoints'] = domain.get('checkpoints', []) + [ET.fromstring(checkpointXML).find('name').text]
+        domain_save(self.name, domain)
+        return 0
+
+    def jobInfo(self):
+        # backup jobs finish immediately
+        return [VIR_DOMAIN_JOB_NONE] + [0] * 11
+
+    def jobStats(self, flags=0):
+        return { 'type': VIR_DOMAIN_JOB_COMPLETED }
+
+class virConnect(object):
+    def lookupByName(self, name):
+        domain_load(name)
+        return virDomain(name)
+
+    def isAlive(self):
+        return 1
+
+    def close(self):
+        return 0
+
+def open(name=None):
+    return virConnect()
@@ -5,26 +5,376 @@ import libvirt
 import sys
 import shutil
 import re
+import shlex
 import time
 import argparse
 import subprocess
 import os
 import fcntl
+import errno
+import json
+import datetime
+import copy
+import threading
+import concurrent.futures
+import contextlib
+import collections
+import ctypes
+import heapq
+import select
+import signal
+import socket
+import hashlib
+import sqlite3
+import struct
 from pathlib import Path
 import xml.etree.ElementTree as ET
 
+# domain -> backupset -> drive, every backup worker only touches the
+# subtree of the domain it holds the lock for
 archive_info = { }
 omit_unsafe = False
+verbose = False
 
-def lock_acquire(lpath):
+# ioctl to share the extents of a file on CoW filesystems like XFS and btrfs
+FICLONE = 0x40049409
+# same for a range, takes a struct file_clone_range
+FICLONERANGE = 0x4020940d
+# fallocate mode to free a range of a file
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# content addressed store for the data of base images, see --dedup
+CHUNK_STORE_DIR = '.qemu-backup-chunks'
+
+# persistent cache of qemu-img info results for images in the backup dir,
+# entries are only trusted while the stat key of the file is unchanged
+INDEX_FILE = '.qemu-backup-index.json'
+# date of the last run of every interval per domain
+STATE_FILE = '.qemu-backup-state.json'
+# bytes read and duration of the last restores, to estimate the next one
+RESTORE_HISTORY_FILE = '.qemu-backup-restore-history.json'
+RESTORE_SAMPLE_SIZE = 256 * 1024 * 1024
+# bytes written and duration of the last runs per domain, for --preflight
+HISTORY_FILE = '.qemu-backup-history.json'
+CHECKSUM_BLOCK_SIZE = 8 * 1024 * 1024
+# upload part size for s3 replicas and the part of an image a rebase rewrites
+REPLICA_PART_SIZE = 16 * 1024 * 1024
+REPLICA_HEAD_SIZE = 65536
+# inotify events on the backup dir that change the archive
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+DAEMON_SOCKET = '/run/qemu-backup.sock'
+# default priorities of daemon jobs, lower runs first
+DAEMON_PRIORITIES = { 'restore': 0, 'backup': 10, 'verify': 20 }
+DAEMON_FINISHED_JOBS = 20
+# options --domain-config may set per domain, the others apply to the whole run
+DOMAIN_CONFIG_KEYS = [
+    'compression', 'compress_deferred', 'copy', 'dedup', 'no_checksums',
+    'export_jobs', 'convert_coroutines', 'convert_out_of_order', 'convert_cache', 'convert_source_cache',
+    'no_trim', 'trim_timeout', 'trim_settle',
+    'freeze', 'freeze_mountpoints', 'freeze_limit', 'freeze_policy', 'freeze_retries',
+    'bandwidth', 'throttle_hours', 'ionice', 'cgroup', 'replica', 'replica_endpoint'
+]
+# pause before freezing again after a freeze went over --freeze-limit
+FREEZE_RETRY_DELAY = 5
+index_dir = None
+image_index = {}
+index_dirty = set()
+index_lock = threading.RLock()
+
+# timings, subprocess counts and bytes written of the current run
+run_report = { 'scan': { 'phases': {}, 'subprocesses': {} }, 'domains': {} }
+report_lock = threading.Lock()
+report_local = threading.local()
+
+# shares of --total-bandwidth, one per concurrent throttled process
+io_slots = None
+# set by the daemon, the archive is only rescanned after the watcher saw
+# changes in the backup dir, qemu-img -p progress per running image
+archive_watch = None
+progress = None
+
+worker_local = threading.local()
+worker_connections = []
+worker_connections_lock = threading.Lock()
+
+def lock_acquire(lpath, blocking=False, shared=False):
   fd = None
   try:
     fd = os.open(lpath, os.O_CREAT)
-    fcntl.flock(fd, fcntl.LOCK_NB | fcntl.LOCK_EX)
-    return True
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    fcntl.flock(fd, mode if blocking else fcntl.LOCK_NB | mode)
+    return fd
   except (OSError, IOError):
     if fd: os.close(fd)
-    return False
+    return None
+
+def lock_release(fd):
+  fcntl.flock(fd, fcntl.LOCK_UN)
+  os.close(fd)
+
+def report_reset():
+    with report_lock:
+        run_report.clear()
+        run_report.update({ 'start': time.time(), 'scan': { 'phases': {}, 'subprocesses': {} }, 'domains': {} })
+
+def report_target(vm_name, drive):
+    if vm_name is None:
+        return run_report['scan']
+    if not vm_name in run_report['domains']:
+        run_report['domains'][vm_name] = { 'phases': {}, 'subprocesses': {}, 'freeze_time': 0, 'drives': {} }
+    if drive is None:
+        return run_report['domains'][vm_name]
+    if not drive in run_report['domains'][vm_name]['drives']:
+        run_report['domains'][vm_name]['drives'][drive] = { 'phases': {}, 'bytes_written': 0 }
+    return run_report['domains'][vm_name]['drives'][drive]
+
+def report_add(vm_name, drive, key, value, phase=False):
+    with report_lock:
+        target = report_target(vm_name, drive)
+        if phase:
+            target = target['phases']
+        target[key] = target.get(key, 0) + value
+
+def report_set(vm_name, key, value):
+    with report_lock:
+        report_target(vm_name, None)[key] = value
+
+@contextlib.contextmanager
+def report_phase(vm_name, phase, drive=None):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        report_add(vm_name, drive, phase, time.monotonic() - start, True)
+
+def run_command(cmd, wrap=[], **kwargs):
+    # subprocesses are counted for the domain the calling thread works on
+    with report_lock:
+        subprocesses = report_target(getattr(report_local, 'domain', None), None)['subprocesses']
+        subprocesses[cmd[0]] = subprocesses.get(cmd[0], 0) + 1
+    if progress is not None and cmd[:2] in [['qemu-img', 'convert'], ['qemu-img', 'commit']]:
+        return run_progress(cmd[:2] + ['-p'] + cmd[2:], wrap, **kwargs)
+    return subprocess.run(wrap + cmd, **kwargs)
+
+def run_progress(cmd, wrap, **kwargs):
+    # qemu-img -p rewrites a line like "    (12.34/100%)" with carriage returns
+    name = '%s: %s' % (getattr(report_local, 'domain', None) or '-', os.path.basename(cmd[-1]))
+    text = kwargs.pop('universal_newlines', False)
+    kwargs['stdout'] = subprocess.PIPE
+    output = b''
+    progress[name] = 0.0
+    try:
+        with subprocess.Popen(wrap + cmd, **kwargs) as process:
+            while True:
+                data = process.stdout.read1(4096)
+                if not data:
+                    break
+                output += data
+                percents = re.findall(rb'\((\d+(?:\.\d+)?)/100%\)', data)
+                if percents:
+                    progress[name] = float(percents[-1])
+            process.wait()
+    finally:
+        progress.pop(name, None)
+    output = re.sub(rb' *\(\d+(?:\.\d+)?/100%\)\r?\n?', b'', output)
+    return subprocess.CompletedProcess(wrap + cmd, process.returncode, output.decode(errors='replace') if text else output)
+
+def throttle_active(args):
+    # bandwidth limits apply all day or in the hours of --throttle-hours
+    if args.throttle_hours == '':
+        return True
+    start, end = [int(hour) for hour in args.throttle_hours.split('-')]
+    hour = datetime.datetime.now().hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+@contextlib.contextmanager
+def io_throttle(args):
+    # yields the rate in bytes per second for one process, the total
+    # bandwidth is split into equal shares for --jobs processes at a time
+    if not throttle_active(args) or (not args.bandwidth and not args.total_bandwidth):
+        yield None
+        return
+    rate = args.bandwidth * 1024**2 if args.bandwidth else None
+    if not args.total_bandwidth or io_slots is None:
+        yield rate
+        return
+    share = args.total_bandwidth * 1024**2 // args.jobs
+    with io_slots:
+        yield min(rate or share, share)
+
+def io_wrapper(args):
+    # io priority and cgroup of the qemu-img processes, io.max of the
+    # cgroup is set up by the admin
+    wrap = []
+    if args.cgroup:
+        wrap += ['sh', '-c', 'echo 0 > "$0/cgroup.procs" && exec "$@"', args.cgroup]
+    if args.ionice == 'idle':
+        wrap += ['ionice', '-c', '3']
+    elif args.ionice:
+        wrap += ['ionice', '-c', '2', '-n', args.ionice.split(':')[1]]
+    return wrap
+
+def run_throttled(cmd, args, **kwargs):
+    # qemu-img convert and commit take a rate in bytes per second, virsh blockcommit in MiB per second
+    with io_throttle(args) as rate:
+        if cmd[0] == 'qemu-img':
+            if rate:
+                cmd = cmd[:2] + ['-r', str(rate)] + cmd[2:]
+            return run_command(cmd, io_wrapper(args), **kwargs)
+        if rate:
+            cmd = cmd + ['--bandwidth', str(max(rate // 1024**2, 1))]
+        return run_command(cmd, **kwargs)
+
+def report_write(args):
+    if args.report:
+        tmp_path = args.report + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(run_report, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, args.report)
+    if args.prometheus:
+        metrics = [
+            '# TYPE qemu_backup_last_run_timestamp_seconds gauge',
+            'qemu_backup_last_run_timestamp_seconds %d' % (run_report['start']),
+            '# TYPE qemu_backup_scan_seconds gauge',
+            'qemu_backup_scan_seconds %f' % (run_report['scan']['phases'].get('scan', 0)),
+            '# TYPE qemu_backup_success gauge',
+            '# TYPE qemu_backup_duration_seconds gauge',
+            '# TYPE qemu_backup_freeze_seconds gauge',
+            '# TYPE qemu_backup_freeze_attempts gauge',
+            '# TYPE qemu_backup_phase_seconds gauge',
+            '# TYPE qemu_backup_subprocesses gauge',
+            '# TYPE qemu_backup_bytes_written gauge',
+            '# TYPE qemu_backup_bytes_deduplicated gauge'
+        ]
+        for vm_name, domain in sorted(run_report['domains'].items()):
+            metrics.append('qemu_backup_success{domain="%s"} %d' % (vm_name, domain.get('status') == 'ok'))
+            metrics.append('qemu_backup_duration_seconds{domain="%s"} %f' % (vm_name, domain.get('duration', 0)))
+            metrics.append('qemu_backup_freeze_seconds{domain="%s"} %f' % (vm_name, domain['freeze_time']))
+            metrics.append('qemu_backup_freeze_attempts{domain="%s"} %d' % (vm_name, domain.get('freeze_attempts', 0)))
+            for phase, seconds in sorted(domain['phases'].items()):
+                metrics.append('qemu_backup_phase_seconds{domain="%s",phase="%s"} %f' % (vm_name, phase, seconds))
+            for command, count in sorted(domain['subprocesses'].items()):
+                metrics.append('qemu_backup_subprocesses{domain="%s",command="%s"} %d' % (vm_name, command, count))
+            for drive, info in sorted(domain['drives'].items()):
+                metrics.append('qemu_backup_bytes_written{domain="%s",drive="%s"} %d' % (vm_name, drive, info['bytes_written']))
+                metrics.append('qemu_backup_bytes_deduplicated{domain="%s",drive="%s"} %d' % (vm_name, drive, info.get('bytes_deduplicated', 0)))
+                for phase, seconds in sorted(info['phases'].items()):
+                    metrics.append('qemu_backup_phase_seconds{domain="%s",drive="%s",phase="%s"} %f' % (vm_name, drive, phase, seconds))
+        tmp_path = args.prometheus + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(metrics) + '\n')
+        os.replace(tmp_path, args.prometheus)
+
+def index_key(stat):
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_ctime_ns]
+
+def index_name(image):
+    if index_dir is None or os.path.dirname(os.path.abspath(image)) != index_dir:
+        return None
+    return os.path.basename(image)
+
+def index_read():
+    try:
+        with open(index_dir + '/' + INDEX_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        print('Warning: ignoring corrupt image index ' + INDEX_FILE)
+    return {}
+
+def index_load(args):
+    global index_dir
+    with index_lock:
+        # the daemon keeps the index in memory, entries are checked against the files anyway
+        if archive_watch is not None and index_dir == os.path.abspath(args.backup_dir) and not args.rebuild_index:
+            return
+        index_dir = os.path.abspath(args.backup_dir)
+        image_index.clear()
+        index_dirty.clear()
+        if not args.rebuild_index:
+            image_index.update(index_read())
+
+def index_save():
+    # merge with the index on disk, other runs may have updated different domains
+    if index_dir is None:
+        return
+    with index_lock:
+        lock = lock_acquire(index_dir + '/' + INDEX_FILE + '.lock', True)
+        try:
+            index = index_read()
+            for name in index_dirty:
+                if name in image_index:
+                    index[name] = image_index[name]
+                elif name in index:
+                    del index[name]
+            for name in list(index.keys()):
+                if not os.path.isfile(index_dir + '/' + name):
+                    del index[name]
+            tmp_path = index_dir + '/' + INDEX_FILE + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_dir + '/' + INDEX_FILE)
+            index_dirty.clear()
+        finally:
+            if lock is not None:
+                lock_release(lock)
+
+def index_lookup(image):
+    name = index_name(image)
+    with index_lock:
+        if name is None or not name in image_index:
+            return None
+        try:
+            stat = os.stat(image)
+        except FileNotFoundError:
+            return None
+        if image_index[name]['key'] != index_key(stat):
+            return None
+        return dict(image_index[name])
+
+def index_update(image, **info):
+    name = index_name(image)
+    if name is None:
+        return
+    with index_lock:
+        entry = image_index.get(name, {})
+        entry.update(info)
+        entry['key'] = index_key(os.stat(image))
+        image_index[name] = entry
+        index_dirty.add(name)
+
+def index_rename(old_filename, new_filename):
+    old_name = index_name(old_filename)
+    new_name = index_name(new_filename)
+    with index_lock:
+        if old_name is None or not old_name in image_index:
+            return
+        entry = image_index.pop(old_name)
+        index_dirty.add(old_name)
+        if new_name is not None:
+            key = index_key(os.stat(new_filename))
+            # a rename keeps the contents, so valid checksum and replica hashes stay valid
+            for hashes in ['checksum', 'replica']:
+                if hashes in entry and entry[hashes]['key'] == entry['key']:
+                    entry[hashes]['key'] = key
+            entry['key'] = key
+            image_index[new_name] = entry
+            index_dirty.add(new_name)
+
+def index_remove(image):
+    name = index_name(image)
+    with index_lock:
+        if name is not None and name in image_index:
+            del image_index[name]
+            index_dirty.add(name)
 
 def check_backup_chain(domain, backupset, devs_to_check, args):
     if not domain in archive_info or not backupset in archive_info[domain]:
@@ -37,11 +387,18 @@ def check_backup_chain(domain, backupset, devs_to_check, args):
                 while num in archive_info[domain][backupset][drive]['images'][interval]:
                     filename = archive_info[domain][backupset][drive]['images'][interval][num];
                     newfilename = filename.replace('.'+str(num)+'.img', '.'+str(num-1)+'.img')
+                    if args.dry_run:
+                        print('%s %s: rename %s %s' % (domain, drive, filename, newfilename))
+                        num = num + 1
+                        continue
                     os.rename(args.backup_dir + '/' + filename, args.backup_dir + '/' + newfilename)
+                    index_rename(args.backup_dir + '/' + filename, args.backup_dir + '/' + newfilename)
                     archive_info[domain][backupset][drive]['images'][interval][num-1] = filename.replace('.'+str(num)+'.img', '.'+str(num-1)+'.img')
                     del archive_info[domain][backupset][drive]['images'][interval][num]
                     num = num + 1
             image_count = len(archive_info[domain][backupset][drive]['images'][interval])
+            if args.dry_run:
+                continue
             if interval != 'base' and image_count != max(archive_info[domain][backupset][drive]['images'][interval].keys()) + 1:
                 raise Exception('Images missing in backup chain for interval ' + interval)
 
@@ -68,38 +425,70 @@ def vm_get_blockdevs(libvirt_conn, vm_name):
         blockdevs[dev] = file
     return blockdevs
 
-def get_backing_file(image):
-    if omit_unsafe:
-        info_output = subprocess.run(['qemu-img', 'info', image], stdout=subprocess.PIPE, universal_newlines=True)
-    else:
-        info_output = subprocess.run(['qemu-img', 'info', '-U', image], stdout=subprocess.PIPE, universal_newlines=True)
+def qemu_img_info(image, backing_chain=False):
+    cmd = ['qemu-img', 'info', '--output=json']
+    if backing_chain:
+        cmd.append('--backing-chain')
+    if not omit_unsafe:
+        cmd.append('-U')
+    info_output = run_command(cmd + [image], stdout=subprocess.PIPE, universal_newlines=True)
     if info_output.returncode != 0:
         raise Exception('Could not get info on file ' + image)
-    info = {}
-    for x in info_output.stdout.split('\n'):
-        x = x.split(':')
-        if len(x) > 1 and x[1] != '':
-            info[x[0].strip()] = x[1].strip()
+    info = json.loads(info_output.stdout)
+    if not backing_chain:
+        info = [info]
+    return [{
+        'backing': x.get('backing-filename', ''),
+        'format': x.get('format', ''),
+        'virtual_size': x.get('virtual-size'),
+        'actual_size': x.get('actual-size'),
+        'cluster_size': x.get('cluster-size')
+    } for x in info]
 
-    if not 'backing file' in info:
+def resolve_backing_file(image, entry):
+    if entry['backing'] == '':
         return ''
 
     p = Path(image)
-    bf = info['backing file'].split(' ')
-    bf_path = Path(bf[0])
+    bf_path = Path(entry['backing'])
 
-    if "/" in bf[0] and p.parent.as_posix() != bf_path.parent.as_posix():
+    if "/" in entry['backing'] and p.parent.as_posix() != bf_path.parent.as_posix():
         img_rebase(image, p.parent.as_posix(), bf_path.name)
+        entry['backing'] = bf_path.name
 
     return p.parent.as_posix() + '/' + bf_path.name
 
+def get_image_info(image):
+    entry = index_lookup(image)
+    if entry is None or not 'backing' in entry:
+        entry = qemu_img_info(image)[0]
+        index_update(image, **entry)
+    return entry
+
+def get_backing_file(image):
+    return resolve_backing_file(image, get_image_info(image))
+
+def get_image_chain(image):
+    # one qemu-img call resolves every link that is not in the index yet
+    chain = []
+    resolved = {}
+    while image != '':
+        entry = resolved.get(image) or index_lookup(image)
+        if entry is None or not 'backing' in entry:
+            link = image
+            for info in qemu_img_info(image, True):
+                resolved[link] = info
+                index_update(link, **info)
+                if info['backing'] == '':
+                    break
+                link = Path(link).parent.as_posix() + '/' + Path(info['backing']).name
+            entry = resolved[image]
+        chain.append(dict(entry, filename=image))
+        image = resolve_backing_file(image, entry)
+    return chain
+
 def get_snapshot_chain(image):
-    snapshot_chain = [ image ]
-    bf = get_backing_file(image)
-    while bf != '':
-        snapshot_chain.append(bf)
-        bf = get_backing_file(bf)
-    return snapshot_chain
+    return [entry['filename'] for entry in get_image_chain(image)]
 
 def get_backup_chain(backup_dir, vm_name):
     chain = {}
@@ -120,91 +509,515 @@ def img_rename(old_filename, new_filename):
     stat = os.stat(old_filename)
     os.rename(old_filename, new_filename)
     os.utime(new_filename, (stat.st_atime, stat.st_mtime))
+    index_rename(old_filename, new_filename)
+
+def img_copy_range(fd_in, fd_out, offset, end, use_copy_file_range):
+    while offset < end:
+        if use_copy_file_range:
+            try:
+                copied = os.copy_file_range(fd_in, fd_out, end - offset, offset, offset)
+            except OSError as e:
+                if not e.errno in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                    raise(e)
+                use_copy_file_range = False
+                continue
+        else:
+            data = os.pread(fd_in, min(COPY_CHUNK_SIZE, end - offset), offset)
+            copied = os.pwrite(fd_out, data, offset)
+        if copied == 0:
+            break
+        offset += copied
+    return use_copy_file_range
+
+def img_copy_file(filename, new_filename):
+    # try a reflink first, then copy only the allocated extents
+    stat = os.stat(filename)
+    with open(filename, 'rb') as fsrc, open(new_filename, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            use_copy_file_range = hasattr(os, 'copy_file_range')
+            offset = 0
+            while offset < stat.st_size:
+                try:
+                    data = os.lseek(fsrc.fileno(), offset, os.SEEK_DATA)
+                    hole = os.lseek(fsrc.fileno(), data, os.SEEK_HOLE)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break # only holes left
+                    if not e.errno in [errno.EINVAL, errno.EOPNOTSUPP]:
+                        raise(e)
+                    data, hole = offset, stat.st_size
+                use_copy_file_range = img_copy_range(fsrc.fileno(), fdst.fileno(), data, hole, use_copy_file_range)
+                offset = hole
+            os.ftruncate(fdst.fileno(), stat.st_size)
+    shutil.copymode(filename, new_filename)
+    os.utime(new_filename, (stat.st_atime, stat.st_mtime))
+
+def img_convert_options(args):
+    options = []
+    if args.convert_coroutines:
+        options += ['-m', str(args.convert_coroutines)]
+    # out of order writes cannot be combined with compression
+    if args.convert_out_of_order and args.compression == 'none':
+        options.append('-W')
+    if args.convert_cache:
+        options += ['-t', args.convert_cache]
+    if args.convert_source_cache:
+        options += ['-T', args.convert_source_cache]
+    return options
+
+def img_compression_options(args):
+    # qemu-img has no setting for the compression level
+    if args.compression == 'zstd':
+        return ['-c', '-o', 'compression_type=zstd']
+    return ['-c']
 
 def img_copy_to_backup_dir(filename, new_filename, args):
     new_path = Path(args.backup_dir + '/' + new_filename)
     if new_path.exists():
         raise ValueError(new_path.name + ' already exists in backup dir. Please clean up manually.')
-    if args.compress:
-        backing_file = get_backing_file(filename)
-        if backing_file:
-            info_output = subprocess.run(['qemu-img', 'convert', '-c', '-f', 'qcow2', '-O', 'qcow2', '-B', backing_file, filename, args.backup_dir+'/'+new_filename], stdout=subprocess.PIPE, universal_newlines=True)
-        else:
-            info_output = subprocess.run(['qemu-img', 'convert', '-c', '-f', 'qcow2', '-O', 'qcow2', filename, args.backup_dir+'/'+new_filename], stdout=subprocess.PIPE, universal_newlines=True)
-        if info_output.returncode != 0:
-            raise Exception('Error compressing ' + filename)
-    elif args.copy:
-        shutil.copy(filename, args.backup_dir+'/'+new_filename)
-    else:
-        backing_file = get_backing_file(filename)
-        if backing_file:
-            info_output = subprocess.run(['qemu-img', 'convert', '-f', 'qcow2', '-O', 'qcow2', '-B', backing_file, filename, args.backup_dir+'/'+new_filename], stdout=subprocess.PIPE, universal_newlines=True)
-        else:
-            info_output = subprocess.run(['qemu-img', 'convert', '-f', 'qcow2', '-O', 'qcow2', filename, args.backup_dir+'/'+new_filename], stdout=subprocess.PIPE, universal_newlines=True)
-        if info_output.returncode != 0:
-            raise Exception('Error converting ' + filename)
+    if args.copy and args.compression == 'none':
+        img_copy_file(filename, args.backup_dir+'/'+new_filename)
+        return
+    cmd = ['qemu-img', 'convert']
+    if args.compression != 'none':
+        cmd += img_compression_options(args)
+    cmd += ['-f', 'qcow2', '-O', 'qcow2'] + img_convert_options(args)
+    backing_file = get_backing_file(filename)
+    if backing_file:
+        cmd += ['-B', backing_file]
+    info_output = run_throttled(cmd + [filename, args.backup_dir+'/'+new_filename], args, stdout=subprocess.PIPE, universal_newlines=True)
+    if info_output.returncode != 0:
+        raise Exception(('Error compressing ' if args.compression != 'none' else 'Error converting ') + filename)
+
+def img_recompress(image, args):
+    # compress a backup image in place, it keeps its backing file and times
+    stat = os.stat(image)
+    tmp_path = image + '.compress'
+    cmd = ['qemu-img', 'convert'] + img_compression_options(args) + ['-f', 'qcow2', '-O', 'qcow2'] + img_convert_options(args)
+    backing_file = get_backing_file(image)
+    if backing_file:
+        cmd += ['-B', Path(backing_file).name]
+    info_output = run_throttled(cmd + [image, tmp_path], args, stdout=subprocess.PIPE, universal_newlines=True, cwd=os.path.dirname(image))
+    if info_output.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise Exception('Error compressing ' + image)
+    shutil.copymode(image, tmp_path)
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    os.replace(tmp_path, image)
+    index_remove(image)
 
 def img_rebase(image, backing_file_dir, new_backing_file):
     stat = os.stat(image)
-    info_output = subprocess.run(['qemu-img', 'rebase', '-u', '-b', new_backing_file, image], stdout=subprocess.PIPE, universal_newlines=True, cwd=backing_file_dir)
+    info_output = run_command(['qemu-img', 'rebase', '-u', '-b', new_backing_file, image], stdout=subprocess.PIPE, universal_newlines=True, cwd=backing_file_dir)
     if info_output.returncode != 0:
         raise Exception('Error rebasing ' + image + ' on ' + new_backing_file)
     os.utime(image, (stat.st_atime, stat.st_mtime))
+    index_update(image, backing=new_backing_file)
 
     # print ('rebase ' + image + ' on ' + new_backing_file)
     return
 
-def img_rotate_interval(vm_name, backupset, interval, dev_to_commit, vm_info, args):
-    # print(archive_info[vm_name]["b%03d" % (backupset)][dev_to_commit])
-    bs = "b%03d" % (backupset)
-    interval_name = args.intervals[interval][0]
-    if not interval_name in archive_info[vm_name][bs][dev_to_commit]['images']:
+def img_checksum(image):
+    # streamed in large blocks, hashlib releases the GIL so images hash in parallel
+    digest = hashlib.sha256()
+    buf = bytearray(CHECKSUM_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(image, 'rb', buffering=0) as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            length = f.readinto(buf)
+            if not length:
+                break
+            digest.update(view[:length])
+        # do not push the running domains out of the page cache
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return digest.hexdigest()
+
+def img_checksum_valid(entry):
+    return entry is not None and 'checksum' in entry and entry['checksum']['key'] == entry['key']
+
+def img_record_checksum(vm_name, dev, image, args):
+    # the checksum is valid while the stat key of the image is unchanged
+    if args.no_checksums:
+        return
+    with report_phase(vm_name, 'checksum', dev):
+        stat = os.stat(image)
+        digest = img_checksum(image)
+        index_update(image, checksum={ 'key': index_key(stat), 'sha256': digest, 'time': int(time.time()) })
+
+def chunk_store_path(args):
+    return args.backup_dir + '/' + CHUNK_STORE_DIR
+
+def chunk_pack_path(args, pack):
+    return chunk_store_path(args) + '/%d.pack' % (pack)
+
+def chunk_store_open(args):
+    # chunks are counted once for every image offset referencing them, the
+    # new chunks of a base image are appended to one pack file
+    db = sqlite3.connect(chunk_store_path(args) + '/chunks.sqlite', timeout=600)
+    db.execute('CREATE TABLE IF NOT EXISTS packs (id INTEGER PRIMARY KEY)')
+    db.execute('CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER, pack INTEGER, offset INTEGER)')
+    db.execute('CREATE INDEX IF NOT EXISTS chunks_pack ON chunks (pack, offset)')
+    db.execute('CREATE TABLE IF NOT EXISTS manifests (image TEXT PRIMARY KEY, size INTEGER, chunk_size INTEGER, thin INTEGER)')
+    db.execute('CREATE TABLE IF NOT EXISTS manifest_chunks (image TEXT, offset INTEGER, hash TEXT, PRIMARY KEY (image, offset))')
+    return db
+
+def chunk_store_drop(db, name):
+    db.execute('UPDATE chunks SET refs = refs - (SELECT COUNT(*) FROM manifest_chunks WHERE image = ? AND manifest_chunks.hash = chunks.hash) WHERE hash IN (SELECT hash FROM manifest_chunks WHERE image = ?)', (name, name))
+    db.execute('DELETE FROM manifest_chunks WHERE image = ?', (name,))
+    db.execute('DELETE FROM manifests WHERE image = ?', (name,))
+
+def chunk_clone(fd_in, fd_out, src_offset, offset, length):
+    try:
+        fcntl.ioctl(fd_out, FICLONERANGE, struct.pack('qQQQ', fd_in, src_offset, length, offset))
+        return True
+    except OSError:
+        return False
+
+def chunk_punch(fd, offset, length):
+    # give the space of unused chunks in a pack back, without moving the others
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+def chunk_runs(chunks):
+    # chunks that follow each other in the image and in a pack are cloned
+    # or copied at once, so the image keeps large extents
+    runs = []
+    for offset, length, pack, pack_offset in chunks:
+        if len(runs) > 0 and runs[-1][2] == pack and runs[-1][0] + runs[-1][1] == offset and runs[-1][3] + runs[-1][1] == pack_offset:
+            runs[-1][1] += length
+        else:
+            runs.append([offset, length, pack, pack_offset])
+    return runs
+
+def chunk_store_ingest(image, args):
+    # move the data of a base image into the chunk store, the image shares
+    # the chunks through reflinks or is left thin until it is materialized
+    name = Path(image).name
+    # chunks of one cluster stay aligned to the data of clones whose allocations differ
+    chunk_size = qemu_img_info(image)[0]['cluster_size'] or 65536
+    stat = os.stat(image)
+    os.makedirs(chunk_store_path(args), exist_ok=True)
+    lock = lock_acquire(chunk_store_path(args) + '/.lock', True, True)
+    db = chunk_store_open(args)
+    try:
+        with db:
+            pack = db.execute('INSERT INTO packs DEFAULT VALUES').lastrowid
+        chunks = []
+        new = {}
+        deduplicated = 0
+        with open(image, 'rb') as f, open(chunk_pack_path(args, pack), 'wb') as fpack:
+            offset = 0
+            while offset < stat.st_size:
+                data = os.pread(f.fileno(), chunk_size, offset)
+                if len(data) == 0:
+                    break
+                if data != bytes(len(data)):
+                    digest = hashlib.sha256(data).hexdigest()
+                    location = new.get(digest) or db.execute('SELECT pack, offset FROM chunks WHERE hash = ?', (digest,)).fetchone()
+                    if location is None:
+                        # only the last chunk of the image can be short, the others stay aligned in the pack
+                        location = (pack, fpack.tell())
+                        fpack.write(data)
+                        new[digest] = location
+                    else:
+                        deduplicated += len(data)
+                    chunks.append((offset, digest, len(data), location))
+                offset += len(data)
+            # one fsync for all new chunks of the image
+            fpack.flush()
+            os.fsync(fpack.fileno())
+        if len(new) == 0:
+            os.unlink(chunk_pack_path(args, pack))
+
+        # the image is marked thin before it is replaced, materializing an intact image does no harm
+        with db:
+            chunk_store_drop(db, name)
+            db.executemany('INSERT INTO chunks VALUES (?, ?, 0, ?, ?) ON CONFLICT(hash) DO NOTHING', [(digest, length, location[0], location[1]) for offset, digest, length, location in chunks if new.get(digest) == location])
+            db.executemany('UPDATE chunks SET refs = refs + 1 WHERE hash = ?', [(digest,) for offset, digest, length, location in chunks])
+            db.executemany('INSERT INTO manifest_chunks VALUES (?, ?, ?)', [(name, offset, digest) for offset, digest, length, location in chunks])
+            db.execute('INSERT INTO manifests VALUES (?, ?, ?, 1)', (name, stat.st_size, chunk_size))
+            # another image ingested meanwhile may have stored the same chunks first
+            lost = [location for digest, location in new.items() if db.execute('SELECT pack, offset FROM chunks WHERE hash = ?', (digest,)).fetchone() != location]
+            if len(new) == 0:
+                db.execute('DELETE FROM packs WHERE id = ?', (pack,))
+
+        tmp_path = image + '.dedup'
+        thin = False
+        packs = {}
+        try:
+            with open(tmp_path, 'wb') as fdst:
+                for offset, length, chunk_pack, pack_offset in chunk_runs([(offset, length, location[0], location[1]) for offset, digest, length, location in chunks]):
+                    if not chunk_pack in packs:
+                        packs[chunk_pack] = os.open(chunk_pack_path(args, chunk_pack), os.O_RDONLY)
+                    if chunk_clone(packs[chunk_pack], fdst.fileno(), pack_offset, offset, length):
+                        continue
+                    if offset == 0:
+                        # keep the image header readable for qemu-img info
+                        os.pwrite(fdst.fileno(), os.pread(packs[chunk_pack], min(length, chunk_size), pack_offset), 0)
+                    if offset > 0 or length > chunk_size:
+                        thin = True
+                os.ftruncate(fdst.fileno(), stat.st_size)
+                os.fsync(fdst.fileno())
+        finally:
+            for fd in packs.values():
+                os.close(fd)
+        shutil.copymode(image, tmp_path)
+        os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+        os.replace(tmp_path, image)
+        index_remove(image)
+        if not thin:
+            with db:
+                db.execute('UPDATE manifests SET thin = 0 WHERE image = ?', (name,))
+        if len(lost) > 0:
+            with open(chunk_pack_path(args, pack), 'r+b') as fpack:
+                for location in lost:
+                    chunk_punch(fpack.fileno(), location[1], chunk_size)
+        if verbose:
+            print('%s: %d of %d bytes deduplicated%s' % (name, deduplicated, stat.st_size, ', thin until materialized' if thin else ''))
+        return deduplicated
+    finally:
+        db.close()
+        lock_release(lock)
+
+def chunk_store_materialize(image, args):
+    # write the chunks back into a thin image
+    name = Path(image).name
+    if not os.path.isdir(chunk_store_path(args)):
+        return False
+    lock = lock_acquire(chunk_store_path(args) + '/.lock', True, True)
+    db = chunk_store_open(args)
+    packs = {}
+    try:
+        manifest = db.execute('SELECT thin FROM manifests WHERE image = ?', (name,)).fetchone()
+        if manifest is None or manifest[0] == 0:
+            return False
+        stat = os.stat(image)
+        with open(image, 'r+b') as fdst:
+            for offset, length, pack, pack_offset in db.execute('SELECT manifest_chunks.offset, size, pack, chunks.offset FROM manifest_chunks JOIN chunks ON chunks.hash = manifest_chunks.hash WHERE image = ? ORDER BY manifest_chunks.offset', (name,)):
+                if not pack in packs:
+                    packs[pack] = os.open(chunk_pack_path(args, pack), os.O_RDONLY)
+                os.pwrite(fdst.fileno(), os.pread(packs[pack], length, pack_offset), offset)
+            os.fsync(fdst.fileno())
+        os.utime(image, (stat.st_atime, stat.st_mtime))
+        index_remove(image)
+        with db:
+            db.execute('UPDATE manifests SET thin = 0 WHERE image = ?', (name,))
+        return True
+    finally:
+        for fd in packs.values():
+            os.close(fd)
+        db.close()
+        lock_release(lock)
+
+def chunk_store_collect(args):
+    # drop the references of base images deleted with their backupset,
+    # punch the chunks nothing refers to anymore out of their packs and
+    # remove the packs without chunks
+    if not os.path.isdir(chunk_store_path(args)):
+        return
+    lock = lock_acquire(chunk_store_path(args) + '/.lock')
+    if lock is None:
+        return # another run is adding images
+    db = chunk_store_open(args)
+    try:
+        with db:
+            for (name,) in db.execute('SELECT image FROM manifests').fetchall():
+                if not os.path.exists(args.backup_dir + '/' + name):
+                    chunk_store_drop(db, name)
+            unused = db.execute('SELECT pack, offset, size FROM chunks WHERE refs <= 0 ORDER BY pack').fetchall()
+            db.execute('DELETE FROM chunks WHERE refs <= 0')
+            # also the packs of interrupted runs
+            empty = [pack for (pack,) in db.execute('SELECT id FROM packs WHERE NOT id IN (SELECT pack FROM chunks)').fetchall()]
+            db.execute('DELETE FROM packs WHERE NOT id IN (SELECT pack FROM chunks)')
+        for pack in empty:
+            if os.path.exists(chunk_pack_path(args, pack)):
+                os.unlink(chunk_pack_path(args, pack))
+        for pack, offset, length in unused:
+            if not pack in empty:
+                with open(chunk_pack_path(args, pack), 'r+b') as fpack:
+                    chunk_punch(fpack.fileno(), offset, length)
+        if verbose and len(unused) > 0:
+            print('Removed %d unused chunks' % (len(unused)))
+    finally:
+        db.close()
+        lock_release(lock)
+
+def chunk_store_thin_images(args):
+    if not os.path.isdir(chunk_store_path(args)):
+        return set()
+    db = chunk_store_open(args)
+    try:
+        return set(name for (name,) in db.execute('SELECT image FROM manifests WHERE thin = 1').fetchall())
+    finally:
+        db.close()
+
+def chunk_store_packs(args):
+    if not os.path.isdir(chunk_store_path(args)):
+        return []
+    db = chunk_store_open(args)
+    try:
+        return [pack for (pack,) in db.execute('SELECT id FROM packs').fetchall()]
+    finally:
+        db.close()
+
+def img_deduplicate(vm_name, dev, image, args):
+    with report_phase(vm_name, 'dedup', dev):
+        report_add(vm_name, dev, 'bytes_deduplicated', chunk_store_ingest(image, args))
+
+def plan_image_entry(filename):
+    imgdata = filename.split('.')
+    # 0: domain name, 1: b<nr>, 2: <drive>, 3: i<nr>[-<nr>], 4: <interval>, 5: <nr>, 6: img
+    return { 'sources': [filename], 'range': imgdata[3].split('-') }
+
+def plan_rotate_interval(state, interval, intervals):
+    interval_name = intervals[interval][0]
+    if not interval_name in state or len(state[interval_name]) == 0:
         return # no images yet
-    images = archive_info[vm_name][bs][dev_to_commit]['images'][interval_name]
+    images = state[interval_name]
 
-    if len(images) >= args.intervals[interval][1]:
+    if len(images) >= intervals[interval][1]:
+        # merge the oldest images into one
         base = max(images.keys())
-        top = args.intervals[interval][1]-2
-        baseimage = images[base]
-        topimage = images[top]
-        stat = os.stat(args.backup_dir + '/' + topimage)
-        info_output = subprocess.run(['qemu-img', 'commit', '-b', args.backup_dir + '/' + baseimage, args.backup_dir + '/' + topimage], stdout=subprocess.PIPE, universal_newlines=True)
-        if info_output.returncode != 0:
-            raise Exception('Error commiting ' + images[top] + ' into ' + images[base])
-        os.utime(args.backup_dir + '/' + baseimage, (stat.st_atime, stat.st_mtime))
-        # commit oldest images
-        for i in range(top, base):
-            os.unlink(args.backup_dir + '/' + images[i])
-            del images[i]
-        del images[base]
-        imgdata_base = baseimage.split('.')
-        imgdata_top = topimage.split('.')
-        imgdata_base[3] = imgdata_base[3].split('-')
-        if len(imgdata_base[3]):
-            imgdata_base[3].append(imgdata_base[3][0])
-        imgdata_top[3] = imgdata_top[3].split('-')
-        imgdata_base[3][1] = imgdata_top[3][0 if (len(imgdata_top[3]) == 1) else 1]
-        imgdata_base[3] = imgdata_base[3][0] + '-' + imgdata_base[3][1]
-        imgdata_base[5] = "%d" % (top)
-        new_name = '.'.join(imgdata_base)
-        img_rename(args.backup_dir + '/' + baseimage, args.backup_dir + '/' + new_name)
-        images[top] = new_name
-        img_rebase(args.backup_dir + '/' + images[top-1], args.backup_dir, new_name)
-
-    for i in range(len(images)-1, -1, -1):
-        old_filename = images[i]
-        new_filename = old_filename.replace("%s.%d" % (interval_name, i), "%s.%d" % (interval_name, i+1))
-        img_rename(args.backup_dir + '/' + old_filename, args.backup_dir + '/' + new_filename)
-        if i != len(images) - 1:
-            img_rebase(args.backup_dir + '/' + new_filename, args.backup_dir, images[i+1].replace("%s.%d" % (interval_name, i+1), "%s.%d" % (interval_name, i+2)))
-        images[i+1] = new_filename
-
-    del images[0]
+        top = max(intervals[interval][1]-2, 0)
+        merged = { 'sources': [], 'range': [images[base]['range'][0], images[top]['range'][-1]] }
+        for i in range(base, top-1, -1):
+            merged['sources'] += images.pop(i)['sources']
+        images[top] = merged
+
+    state[interval_name] = dict((i+1, entry) for i, entry in images.items())
+
+def plan_promote(state, interval, intervals):
+    interval_name = intervals[interval-1][0]
+    new_interval_name = intervals[interval][0]
+    if not interval_name in state or len(state[interval_name]) <= 1:
+        return # no backup yet
+    lowest_image = max(state[interval_name].keys())
+    if not new_interval_name in state:
+        state[new_interval_name] = {}
+    if 0 in state[new_interval_name]:
+        plan_rotate_interval(state, interval, intervals)
+    state[new_interval_name][0] = state[interval_name].pop(lowest_image)
+
+def plan_retention(vm_name, backupset, dev, images, backing_files, steps, intervals):
+    # compute the target layout of all intervals first, then the operations to get there
+    state = {}
+    for interval_name in images:
+        if interval_name != 'base':
+            state[interval_name] = dict((i, plan_image_entry(filename)) for i, filename in images[interval_name].items())
+    for step, interval in steps:
+        if step == 'promote':
+            plan_promote(state, interval, intervals)
+        else:
+            plan_rotate_interval(state, interval, intervals)
+
+    new_images = {}
+    new_names = {}
+    for interval_name in state:
+        new_images[interval_name] = {}
+        for i, entry in state[interval_name].items():
+            entry['name'] = "%s.%s.%s.%s.%s.%d.img" % (vm_name, backupset, dev, '-'.join(entry['range'] if entry['range'][0] != entry['range'][-1] else entry['range'][:1]), interval_name, i)
+            new_images[interval_name][i] = entry['name']
+            for filename in entry['sources']:
+                new_names[filename] = entry['name']
+
+    commits, unlinks, renames, rebases = [], [], [], []
+    for interval_name in state:
+        for entry in state[interval_name].values():
+            if len(entry['sources']) > 1:
+                commits.append(['commit', entry['sources'][0], entry['sources'][-1]])
+                unlinks += [['unlink', filename] for filename in entry['sources'][1:]]
+            if entry['sources'][0] != entry['name']:
+                renames.append(['rename', entry['sources'][0], entry['name']])
+            backing_file = backing_files[entry['sources'][0]]
+            if new_names.get(backing_file, backing_file) != backing_file:
+                rebases.append(['rebase', entry['name'], new_names[backing_file]])
+
+    # rename into names that are freed up by earlier renames only
+    ordered_renames = []
+    while len(renames) > 0:
+        occupied = set(op[1] for op in renames)
+        ready = [op for op in renames if not op[2] in occupied]
+        if len(ready) == 0:
+            raise Exception('Cannot order renames for ' + vm_name + ' ' + backupset + ' ' + dev)
+        ordered_renames += ready
+        renames = [op for op in renames if not op in ready]
+
+    return commits + unlinks + ordered_renames + rebases, new_images
+
+def journal_path(vm_name, backupset, dev, args):
+    return args.backup_dir + '/.qemu-backup-journal.%s.%s.%s.json' % (vm_name, backupset, dev)
+
+def journal_write(path, journal):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def apply_plan(path, journal, args):
+    # every operation can be repeated, so an interrupted journal is replayed from the last finished one
+    for op in journal['ops'][journal['done']:]:
+        if op[0] == 'commit':
+            if len(op) == 3:
+                stat = os.stat(args.backup_dir + '/' + op[2])
+                op += [stat.st_atime, stat.st_mtime]
+                journal_write(path, journal)
+            allocated = os.stat(args.backup_dir + '/' + op[1]).st_blocks
+            info_output = run_throttled(['qemu-img', 'commit', '-d', '-b', args.backup_dir + '/' + op[1], args.backup_dir + '/' + op[2]], args, stdout=subprocess.PIPE, universal_newlines=True)
+            if info_output.returncode != 0:
+                raise Exception('Error commiting ' + op[2] + ' into ' + op[1])
+            report_add(journal['domain'], journal.get('drive'), 'bytes_written', max(os.stat(args.backup_dir + '/' + op[1]).st_blocks - allocated, 0) * 512)
+            os.utime(args.backup_dir + '/' + op[1], (op[3], op[4]))
+            index_update(args.backup_dir + '/' + op[1])
+        elif op[0] == 'unlink':
+            if os.path.exists(args.backup_dir + '/' + op[1]):
+                os.unlink(args.backup_dir + '/' + op[1])
+            index_remove(args.backup_dir + '/' + op[1])
+        elif op[0] == 'rename':
+            if os.path.exists(args.backup_dir + '/' + op[1]):
+                if os.path.exists(args.backup_dir + '/' + op[2]):
+                    raise Exception(op[2] + ' already exists')
+                img_rename(args.backup_dir + '/' + op[1], args.backup_dir + '/' + op[2])
+        elif op[0] == 'rebase':
+            img_rebase(args.backup_dir + '/' + op[1], args.backup_dir, op[2])
+        journal['done'] += 1
+        journal_write(path, journal)
+    if journal.get('promoted'):
+        state_record(journal['domain'], journal['promoted'], args, datetime.date.fromisoformat(journal['date']))
+    os.unlink(path)
+
+def journal_replay(vm_name, args):
+    # the caller holds the lock of the domain, a journal that cannot be
+    # applied is kept and fails this domain only
+    failed = []
+    for path in sorted(Path(args.backup_dir).glob('.qemu-backup-journal.' + vm_name + '.*.json')):
+        try:
+            with open(path.as_posix()) as f:
+                journal = json.load(f)
+            if journal['domain'] != vm_name:
+                continue
+            print('Resuming interrupted rotation of ' + path.name)
+            apply_plan(path.as_posix(), journal, args)
+        except Exception as e:
+            print('Resuming rotation of ' + path.name + ' failed: ' + str(e))
+            failed.append(path.name)
+        # the watcher may see the renames only later
+        if archive_watch is not None:
+            archive_watch['changed'].set()
+    if len(failed) > 0:
+        raise Exception('Interrupted rotation not finished: ' + ', '.join(failed))
 
 def vm_commit_first(libvirt_conn, vm_name, vm_info, devs_to_commit, args):
     for dev in devs_to_commit:
         if len(vm_info[dev]['chain']) > 1:
-            info_output = subprocess.run(['virsh', 'blockcommit', vm_name, dev, '--wait', '--top' , vm_info[dev]['chain'][-2]], stdout=subprocess.PIPE, universal_newlines=True)
+            with report_phase(vm_name, 'blockcommit', dev):
+                info_output = run_throttled(['virsh', 'blockcommit', vm_name, dev, '--wait', '--top' , vm_info[dev]['chain'][-2]], args, stdout=subprocess.PIPE, universal_newlines=True)
             if info_output.returncode != 0:
                 raise Exception('Error commiting changes for ' + dev + ' of ' + vm_name)
 
@@ -231,7 +1044,8 @@ def vm_commit_all(libvirt_conn, vm_name, vm_info, devs_to_commit, args):
 
     for dev in devs_to_commit:
         if len(vm_info[dev]['chain']) > 1:
-            info_output = subprocess.run(['virsh', 'blockcommit', vm_name, dev, '--active', '--wait', '--pivot'], stdout=subprocess.PIPE, universal_newlines=True)
+            with report_phase(vm_name, 'blockcommit', dev):
+                info_output = run_throttled(['virsh', 'blockcommit', vm_name, dev, '--active', '--wait', '--pivot'], args, stdout=subprocess.PIPE, universal_newlines=True)
             if info_output.returncode != 0:
                 raise Exception('Error commiting changes for ' + dev + ' of ' + vm_name)
 
@@ -245,7 +1059,18 @@ def vm_commit_all(libvirt_conn, vm_name, vm_info, devs_to_commit, args):
                 os.unlink(img)
         vm_info[dev]['chain'] = chain
 
-def vm_trim(libvirt_conn, vm_name):
+def img_wait_allocation_settled(images, deadline, poll_interval):
+    allocated = None
+    while time.monotonic() < deadline:
+        current = [os.stat(image).st_blocks for image in images]
+        if current == allocated:
+            return
+        allocated = current
+        time.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+def vm_trim(libvirt_conn, vm_name, vm_info, args):
+    if args.no_trim:
+        return None
     try:
         vm = libvirt_conn.lookupByName(vm_name)
     except libvirt.libvirtError as e:
@@ -255,12 +1080,94 @@ def vm_trim(libvirt_conn, vm_name):
             exit(1)
         else:
             raise(e)
+    start = time.monotonic()
     try:
-        vm.fSTrim(None, 0, 0)
-        time.sleep(240)
+        # fSTrim blocks until the guest agent returns, the agent timeout bounds it
+        if hasattr(vm, 'agentSetResponseTimeout'):
+            vm.agentSetResponseTimeout(args.trim_timeout, 0)
+        try:
+            vm.fSTrim(None, 0, 0)
+        finally:
+            if hasattr(vm, 'agentSetResponseTimeout'):
+                vm.agentSetResponseTimeout(getattr(libvirt, 'VIR_DOMAIN_AGENT_RESPONSE_TIMEOUT_DEFAULT', -1), 0)
     except libvirt.libvirtError as e:
         print('Warning')
         print(e)
+        return None
+    if args.trim_settle:
+        img_wait_allocation_settled([vm_info[dev]['chain'][0] for dev in vm_info], start + args.trim_timeout, args.trim_settle)
+    trim_time = time.monotonic() - start
+    report_add(vm_name, None, 'trim', trim_time, True)
+    if verbose:
+        print('%s: trim took %.1f seconds' % (vm_name, trim_time))
+    return trim_time
+
+def vm_freeze_mountpoints(args):
+    # a comma separated list on the command line, a list in the domain config
+    mountpoints = args.freeze_mountpoints
+    if isinstance(mountpoints, str):
+        mountpoints = [mountpoint for mountpoint in mountpoints.split(',') if mountpoint]
+    return mountpoints or None
+
+def vm_frozen(vm, vm_name, action, args):
+    # runs action with the guest filesystems frozen, everything else must be
+    # prepared before, the frozen time from fsFreeze to fsThaw is reported
+    if args.freeze == 'none':
+        return action()
+    mountpoints = vm_freeze_mountpoints(args)
+    attempts = args.freeze_retries + 1 if args.freeze_limit and args.freeze_policy != 'warn' else 1
+    for attempt in range(attempts):
+        if attempt > 0:
+            time.sleep(FREEZE_RETRY_DELAY)
+        start = time.monotonic()
+        vm.fsFreeze(mountpoints, 0)
+        try:
+            # the guest flushes its dirty pages while freezing, a slow freeze is
+            # thawed right away and not extended by the action
+            if args.freeze_limit and args.freeze_policy != 'warn' and time.monotonic() - start > args.freeze_limit:
+                continue
+            result = action()
+        finally:
+            vm.fsThaw(mountpoints, 0)
+            freeze_time = time.monotonic() - start
+            report_add(vm_name, None, 'freeze_time', freeze_time)
+            report_add(vm_name, None, 'freeze_attempts', 1)
+            if verbose:
+                print('%s: filesystems frozen for %.3f seconds' % (vm_name, freeze_time))
+        if args.freeze_limit and freeze_time > args.freeze_limit:
+            print('Warning')
+            print('%s: filesystems frozen for %.3f seconds, limit is %.3f' % (vm_name, freeze_time, args.freeze_limit))
+        return result
+    if args.freeze_policy == 'retry':
+        raise Exception('Could not freeze filesystems of ' + vm_name + ' within ' + str(args.freeze_limit) + ' seconds')
+    print('Warning')
+    print('%s: could not freeze filesystems within %.3f seconds, continuing without freeze' % (vm_name, args.freeze_limit))
+    report_set(vm_name, 'quiesced', False)
+    return action()
+
+def vm_create_overlays(overlays):
+    # the overlays are created before the snapshot, libvirt reuses them, the
+    # size is given because qemu-img can not open the backing file of a running domain
+    created = []
+    try:
+        for image, backing in overlays:
+            if os.path.exists(image):
+                raise Exception('Overlay ' + image + ' already exists')
+            info = get_image_info(backing)
+            cmd = ['qemu-img', 'create', '-f', 'qcow2', '-F', info['format'], '-b', os.path.abspath(backing), '-u', image, str(info['virtual_size'])]
+            info_output = run_command(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            if info_output.returncode != 0:
+                raise Exception('Could not create overlay ' + image)
+            created.append(image)
+    except Exception:
+        vm_remove_overlays(created)
+        raise
+    return created
+
+def vm_remove_overlays(overlays):
+    for image in overlays:
+        if os.path.exists(image):
+            os.unlink(image)
 
 def vm_snapshot(libvirt_conn, vm_name, vm_info, vm_devs, devs_to_snapshot, backupset, args):
     try:
@@ -273,27 +1180,320 @@ def vm_snapshot(libvirt_conn, vm_name, vm_info, vm_devs, devs_to_snapshot, backu
         else:
             raise(e)
 
+    overlays = []
     xml = "<domainsnapshot><name>b%03d.snapshot</name><disks>" % (backupset)
     for dev in devs_to_snapshot:
-        xml += "<disk name='%s'><source file='%s.b%03d.i%05d.img'/></disk>"  % (vm_info[dev]['chain'][0], vm_info[dev]['chain'][len(vm_info[dev]['chain'])-1][:-4], backupset, vm_info[dev]['nr']+1)
+        overlay = '%s.b%03d.i%05d.img' % (vm_info[dev]['chain'][len(vm_info[dev]['chain'])-1][:-4], backupset, vm_info[dev]['nr']+1)
+        overlays.append((overlay, vm_info[dev]['chain'][0]))
+        xml += "<disk name='%s'><source file='%s'/></disk>"  % (vm_info[dev]['chain'][0], overlay)
     for dev in vm_devs:
         if not dev in devs_to_snapshot:
             xml += "<disk name='%s' snapshot='no' />" % (dev)
     xml += "</disks></domainsnapshot>"
 
-    snapshot = vm.snapshotCreateXML(xml, libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY + libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE + libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC)
+    flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY + libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+    if args.freeze == 'quiesce':
+        # libvirt freezes the guest filesystems and creates the overlays
+        start = time.monotonic()
+        snapshot = vm.snapshotCreateXML(xml, flags + libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE)
+        report_add(vm_name, None, 'snapshot', time.monotonic() - start, True)
+        report_add(vm_name, None, 'freeze_time', time.monotonic() - start)
+        if args.freeze_limit and time.monotonic() - start > args.freeze_limit:
+            print('Warning')
+            print('%s: snapshot took %.3f seconds, limit is %.3f, try --freeze explicit' % (vm_name, time.monotonic() - start, args.freeze_limit))
+    else:
+        # only the snapshot itself happens while the filesystems are frozen
+        created = vm_create_overlays(overlays)
+        start = time.monotonic()
+        try:
+            snapshot = vm_frozen(vm, vm_name, lambda: vm.snapshotCreateXML(xml, flags + libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT), args)
+        except Exception:
+            vm_remove_overlays(created)
+            raise
+        report_add(vm_name, None, 'snapshot', time.monotonic() - start, True)
     snapshot.delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY)
-    for dev in devs_to_snapshot:
-        if len(vm_info[dev]['chain']) < 2:
-            img_copy_to_backup_dir(vm_info[dev]['chain'][0], "%s.b%03d.%s.base.img" % (vm_name, backupset, dev), args)
-        else:
-            new_name = "%s.b%03d.%s.i%05d.%s.%d.img" % (vm_name, backupset, dev, vm_info[dev]['nr'], args.intervals[0][0], 0)
+    # export all drives at once while the domain runs on the new overlays
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.export_jobs or len(devs_to_snapshot) or 1) as executor:
+        futures = [executor.submit(vm_export_drive, vm_name, vm_info, dev, backupset, args) for dev in devs_to_snapshot]
+    for future in futures:
+        future.result()
+
+def vm_export_drive(vm_name, vm_info, dev, backupset, args):
+    report_local.domain = vm_name
+    if len(vm_info[dev]['chain']) < 2:
+        new_name = "%s.b%03d.%s.base.img" % (vm_name, backupset, dev)
+        with report_phase(vm_name, 'export', dev):
             img_copy_to_backup_dir(vm_info[dev]['chain'][0], new_name, args)
-            if vm_info[dev]['nr']-1 == 0:
-                baseimage = "%s.b%03d.%s.base.img" % (vm_name, backupset, dev)
+        report_add(vm_name, dev, 'bytes_written', os.stat(args.backup_dir + '/' + new_name).st_blocks * 512)
+        if args.dedup:
+            img_deduplicate(vm_name, dev, args.backup_dir + '/' + new_name, args)
+        img_record_checksum(vm_name, dev, args.backup_dir + '/' + new_name, args)
+    else:
+        new_name = "%s.b%03d.%s.i%05d.%s.%d.img" % (vm_name, backupset, dev, vm_info[dev]['nr'], args.intervals[0][0], 0)
+        export_args = args
+        if args.compress_deferred and args.compression != 'none':
+            # compressed after the commit, the domain leaves the overlay sooner
+            export_args = copy.copy(args)
+            export_args.compression = 'none'
+            vm_info[dev]['recompress'] = args.backup_dir + '/' + new_name
+        with report_phase(vm_name, 'export', dev):
+            img_copy_to_backup_dir(vm_info[dev]['chain'][0], new_name, export_args)
+        report_add(vm_name, dev, 'bytes_written', os.stat(args.backup_dir + '/' + new_name).st_blocks * 512)
+        if vm_info[dev]['nr']-1 == 0:
+            baseimage = "%s.b%03d.%s.base.img" % (vm_name, backupset, dev)
+        else:
+            baseimage = "%s.b%03d.%s.i%05d.%s.%d.img" % (vm_name, backupset, dev, vm_info[dev]['nr']-1, args.intervals[0][0], 1)
+        img_rebase(args.backup_dir + '/' + new_name, args.backup_dir, baseimage)
+        if not 'recompress' in vm_info[dev]:
+            img_record_checksum(vm_name, dev, args.backup_dir + '/' + new_name, args)
+
+def vm_recompress(vm_name, images, args):
+    def recompress(dev, image):
+        report_local.domain = vm_name
+        allocated = os.stat(image).st_blocks
+        with report_phase(vm_name, 'recompress', dev):
+            img_recompress(image, args)
+        # the export already counted the image uncompressed, its size is replaced
+        report_add(vm_name, dev, 'bytes_written', (os.stat(image).st_blocks - allocated) * 512)
+        img_record_checksum(vm_name, dev, image, args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.export_jobs or len(images) or 1) as executor:
+        futures = [executor.submit(recompress, dev, image) for dev, image in images.items()]
+    for future in futures:
+        future.result()
+
+def vm_get_checkpoint(vm):
+    latest = None
+    for checkpoint in vm.listAllCheckpoints(0):
+        match = re.match(r'^b(\d+)\.i(\d+)$', checkpoint.getName())
+        if match and (latest is None or (int(match.group(1)), int(match.group(2))) > latest[:2]):
+            latest = (int(match.group(1)), int(match.group(2)), checkpoint.getName())
+    return latest
+
+def vm_wait_job(vm, vm_name):
+    while vm.jobInfo()[0] != libvirt.VIR_DOMAIN_JOB_NONE:
+        time.sleep(1)
+    stats = vm.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+    if stats.get('type') != libvirt.VIR_DOMAIN_JOB_COMPLETED:
+        raise Exception('Backup job of ' + vm_name + ' failed')
+
+def vm_backup_begin(libvirt_conn, vm_name, vm_devs, devs_to_backup, targets, checkpoint, incremental, args):
+    try:
+        vm = libvirt_conn.lookupByName(vm_name)
+    except libvirt.libvirtError as e:
+        # Error code 42 = Domain not found
+        if (e.get_error_code() == 42):
+            print(e)
+            exit(1)
+        else:
+            raise(e)
+
+    xml = "<domainbackup mode='push'>"
+    if incremental:
+        xml += "<incremental>%s</incremental>" % (incremental)
+    xml += "<disks>"
+    for dev in devs_to_backup:
+        xml += "<disk name='%s' type='file'><target file='%s'/><driver type='qcow2'/></disk>" % (dev, targets[dev])
+    for dev in vm_devs:
+        if not dev in devs_to_backup:
+            xml += "<disk name='%s' backup='no'/>" % (dev)
+    xml += "</disks></domainbackup>"
+
+    checkpoint_xml = "<domaincheckpoint><name>%s</name><disks>" % (checkpoint)
+    for dev in vm_devs:
+        checkpoint_xml += "<disk name='%s' checkpoint='%s'/>" % (dev, 'bitmap' if dev in devs_to_backup else 'no')
+    checkpoint_xml += "</disks></domaincheckpoint>"
+
+    # the backup point in time and the new checkpoint are set when backupBegin returns
+    vm_frozen(vm, vm_name, lambda: vm.backupBegin(xml, checkpoint_xml, 0), args)
+
+    try:
+        with report_phase(vm_name, 'backup_job'):
+            vm_wait_job(vm, vm_name)
+        for dev in devs_to_backup:
+            report_add(vm_name, dev, 'bytes_written', os.stat(targets[dev]).st_blocks * 512)
+    except Exception:
+        # deleting the new checkpoint merges its bitmap back into the previous one
+        vm.checkpointLookupByName(checkpoint, 0).delete(0)
+        for dev in devs_to_backup:
+            if os.path.exists(targets[dev]):
+                os.unlink(targets[dev])
+        raise
+
+    for old_checkpoint in vm.listAllCheckpoints(0):
+        if old_checkpoint.getName() != checkpoint and re.match(r'^b(\d+)\.i(\d+)$', old_checkpoint.getName()):
+            old_checkpoint.delete(0)
+
+def vm_backup_bitmap(libvirt_conn, vm, blockdevs, args):
+    try:
+        checkpoint = vm_get_checkpoint(libvirt_conn.lookupByName(vm[0]))
+    except libvirt.libvirtError as e:
+        # Error code 42 = Domain not found
+        if (e.get_error_code() == 42):
+            print(e)
+            exit(1)
+        else:
+            raise(e)
+
+    vm_info = {}
+    for dev in vm[1]:
+        if not dev in blockdevs:
+            raise LookupError('Unknown block device for domain ' + vm[0] + ': ' + dev)
+        vm_info[dev] = { 'chain': get_snapshot_chain(blockdevs[dev]) }
+    devs_with_snapshots = [dev for dev in vm[1] if len(vm_info[dev]['chain']) > 1]
+
+    # full backup into a new backupset
+    if checkpoint is None or args.new_chain or len(devs_with_snapshots) > 0:
+        backupsets = [int(backupset[1:]) for backupset in archive_info.get(vm[0], {})]
+        if checkpoint is not None:
+            backupsets.append(checkpoint[0])
+        active_backupset = max(backupsets, default=0) + 1
+        if args.dry_run:
+            print('%s %s: create backup chain b%03d' % (vm[0], ','.join(vm[1]), active_backupset))
+            return
+        if len(devs_with_snapshots) > 0:
+            vm_commit_all(libvirt_conn, vm[0], vm_info, devs_with_snapshots, args)
+        targets = {}
+        for dev in vm[1]:
+            targets[dev] = args.backup_dir + '/' + "%s.b%03d.%s.base.img" % (vm[0], active_backupset, dev)
+            if os.path.exists(targets[dev]):
+                raise ValueError(Path(targets[dev]).name + ' already exists in backup dir. Please clean up manually.')
+        vm_trim(libvirt_conn, vm[0], vm_info, args)
+        vm_backup_begin(libvirt_conn, vm[0], blockdevs, vm[1], targets, "b%03d.i%05d" % (active_backupset, 0), None, args)
+        if args.compression != 'none':
+            vm_recompress(vm[0], targets, args)
+        for dev in vm[1]:
+            if args.dedup:
+                img_deduplicate(vm[0], dev, targets[dev], args)
+            if args.dedup or args.compression == 'none':
+                img_record_checksum(vm[0], dev, targets[dev], args)
+        state_record(vm[0], [args.intervals[0][0]], args)
+        return
+
+    active_backupset, nr = checkpoint[0], checkpoint[1]
+    for dev in vm[1]:
+        vm_info[dev].update({ 'backupset': active_backupset, 'nr': nr })
+
+    check_backup_chain(vm[0], "b%03d" % (active_backupset), vm[1], args)
+
+    # move existing backups to make room for new incremental
+    steps = backup_steps(vm[0], args)
+    vm_rotate_backups(vm[0], vm[1], active_backupset, vm_info, steps, args)
+
+    if steps[-1][0] == 'rotate' and args.dry_run:
+        print('%s %s: create incremental backup' % (vm[0], ','.join(vm[1])))
+    elif steps[-1][0] == 'rotate':
+        # export the clusters changed since the last checkpoint
+        targets = {}
+        for dev in vm[1]:
+            targets[dev] = args.backup_dir + '/' + "%s.b%03d.%s.i%05d.%s.%d.img" % (vm[0], active_backupset, dev, nr+1, args.intervals[0][0], 0)
+            if os.path.exists(targets[dev]):
+                raise ValueError(Path(targets[dev]).name + ' already exists in backup dir. Please clean up manually.')
+        vm_trim(libvirt_conn, vm[0], vm_info, args)
+        vm_backup_begin(libvirt_conn, vm[0], blockdevs, vm[1], targets, "b%03d.i%05d" % (active_backupset, nr+1), checkpoint[2], args)
+        for dev in vm[1]:
+            if nr == 0:
+                baseimage = "%s.b%03d.%s.base.img" % (vm[0], active_backupset, dev)
             else:
-                baseimage = "%s.b%03d.%s.i%05d.%s.%d.img" % (vm_name, backupset, dev, vm_info[dev]['nr']-1, args.intervals[0][0], 1)
-            img_rebase(args.backup_dir + '/' + new_name, args.backup_dir, baseimage)
+                baseimage = "%s.b%03d.%s.i%05d.%s.%d.img" % (vm[0], active_backupset, dev, nr, args.intervals[0][0], 1)
+            img_rebase(targets[dev], args.backup_dir, baseimage)
+        if args.compression != 'none':
+            vm_recompress(vm[0], targets, args)
+        else:
+            for dev in vm[1]:
+                img_record_checksum(vm[0], dev, targets[dev], args)
+    if not args.dry_run:
+        state_record(vm[0], [args.intervals[step[1]][0] for step in steps], args)
+
+def interval_boundary(interval_name, today):
+    # start of the current period of an interval
+    if interval_name == 'daily':
+        return today
+    if interval_name == 'weekly':
+        return today - datetime.timedelta(days=today.isoweekday() % 7)
+    if interval_name == 'monthly':
+        return today.replace(day=1)
+    if interval_name == 'yearly':
+        return today.replace(month=1, day=1)
+    raise ValueError('Cannot schedule interval ' + interval_name + ' automatically')
+
+def state_read(args):
+    try:
+        with open(args.backup_dir + '/' + STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def state_record(vm_name, interval_names, args, date=None):
+    lock = lock_acquire(args.backup_dir + '/' + STATE_FILE + '.lock', True)
+    try:
+        state = state_read(args)
+        if not vm_name in state:
+            state[vm_name] = {}
+        for interval_name in interval_names:
+            state[vm_name][interval_name] = (date or args.today).isoformat()
+        tmp_path = args.backup_dir + '/' + STATE_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, args.backup_dir + '/' + STATE_FILE)
+    finally:
+        if lock is not None:
+            lock_release(lock)
+
+def backup_steps(vm_name, args):
+    if not args.auto_intervals:
+        return [('promote', args.interval)] if args.interval > 0 else [('rotate', 0)]
+
+    # an interval is due when its period started after its last run, or
+    # starts today if it never ran
+    last_run = state_read(args).get(vm_name, {})
+    steps = []
+    for interval in range(len(args.intervals)-1, 0, -1):
+        boundary = interval_boundary(args.intervals[interval][0], args.today)
+        if args.intervals[interval][0] in last_run:
+            due = datetime.date.fromisoformat(last_run[args.intervals[interval][0]]) < boundary
+        else:
+            due = args.today == boundary
+        if due:
+            steps.append(('promote', interval))
+    return steps + [('rotate', 0)]
+
+def rotation_plan(vm_name, backupset, dev, steps, args):
+    images = archive_info[vm_name][backupset][dev]['images']
+    backing_files = {}
+    for interval_name in images:
+        if interval_name != 'base':
+            for filename in images[interval_name].values():
+                backing_files[filename] = Path(get_image_info(args.backup_dir + '/' + filename)['backing']).name
+    return plan_retention(vm_name, backupset, dev, images, backing_files, steps, args.intervals)
+
+def vm_rotate_backups(vm_name, devs, active_backupset, vm_info, steps, args):
+    backupset = "b%03d" % (active_backupset)
+    for dev in devs:
+        if steps[0][0] == 'promote':
+            # check if there is an image that can move to interval.0
+            if not backupset in archive_info[vm_name]:
+                raise Exception('No backup images found in backupset')
+            if not dev in archive_info[vm_name][backupset]:
+                raise Exception('No backup images for drive found in backupset')
+        if not backupset in archive_info.get(vm_name, {}) or not dev in archive_info[vm_name][backupset]:
+            continue # no backup yet
+
+        images = archive_info[vm_name][backupset][dev]['images']
+        ops, new_images = rotation_plan(vm_name, backupset, dev, steps, args)
+
+        if args.dry_run:
+            for op in ops:
+                print('%s %s: %s' % (vm_name, dev, ' '.join(op)))
+            continue
+        if len(ops) > 0:
+            path = journal_path(vm_name, backupset, dev, args)
+            # the promoted intervals count as run once the journal is applied, even if the backup fails later
+            promoted = [args.intervals[step[1]][0] for step in steps if step[0] == 'promote']
+            journal = { 'domain': vm_name, 'drive': dev, 'ops': ops, 'done': 0, 'promoted': promoted, 'date': args.today.isoformat() }
+            journal_write(path, journal)
+            with report_phase(vm_name, 'rotate', dev):
+                apply_plan(path, journal, args)
+        images.update(new_images)
 
 def vm_backup(libvirt_conn, vm, args):
     blockdevs = vm_get_blockdevs(libvirt_conn, vm[0])
@@ -303,6 +1503,9 @@ def vm_backup(libvirt_conn, vm, args):
         for dev in blockdevs:
             vm[1].append(dev)
 
+    if args.engine == 'bitmap':
+        return vm_backup_bitmap(libvirt_conn, vm, blockdevs, args)
+
     vm_info = {}
 
     active_backupset = 0
@@ -345,61 +1548,62 @@ def vm_backup(libvirt_conn, vm, args):
 
     # backup base image
     if len(incomplete_snapshots) > 0 or args.new_chain:
+        if args.dry_run:
+            print('%s %s: create backup chain b%03d' % (vm[0], ','.join(incomplete_snapshots), active_backupset))
+            return
         vm_commit_all(libvirt_conn, vm[0], vm_info, incomplete_snapshots, args)
-        vm_trim(libvirt_conn, vm[0])
+        vm_trim(libvirt_conn, vm[0], vm_info, args)
         vm_snapshot(libvirt_conn, vm[0], vm_info, blockdevs, incomplete_snapshots, active_backupset, args)
+        state_record(vm[0], [args.intervals[0][0]], args)
     else:
         # move existing backups to make room for new incremental
-        interval = args.interval
-        for dev in vm[1]:
-            # check if there is an image that can move to interval.0
-            if interval > 0:
-                interval_name = args.intervals[interval-1][0]
-                backupset = "b%03d" % (active_backupset)
-                if not backupset in archive_info[vm[0]]:
-                    raise Exception('No backup images found in backupset')
-                if not dev in archive_info[vm[0]][backupset]:
-                    raise Exception('No backup images for drive found in backupset')
-                if not interval_name in archive_info[vm[0]][backupset][dev]['images']:
-                    continue # no backup yet
-                imagecount = len(archive_info[vm[0]][backupset][dev]['images'][interval_name])
-                if imagecount == 1:
-                    continue # no backup yet
-
-                lowest_image = max(archive_info[vm[0]][backupset][dev]['images'][interval_name].keys())
-                old_filename = archive_info[vm[0]][backupset][dev]['images'][interval_name][lowest_image]
-                new_interval_name = args.intervals[interval][0]
-                new_filename = old_filename.replace(interval_name + ".%d" % (lowest_image), "%s.0" % (new_interval_name))
-                new_path = Path(args.backup_dir + '/' + new_filename)
-                if not new_interval_name in archive_info[vm[0]][backupset][dev]['images']:
-                    archive_info[vm[0]][backupset][dev]['images'][new_interval_name] = {}
-                if 0 in archive_info[vm[0]][backupset][dev]['images'][new_interval_name]:
-                    img_rotate_interval(vm[0], active_backupset, interval, dev, vm_info, args)
-                if new_path.exists():
-                    raise Exception(new_filename + ' already exists')
-                img_rename(args.backup_dir + '/' + old_filename, args.backup_dir + '/' + new_filename)
-                del archive_info[vm[0]][backupset][dev]['images'][interval_name][lowest_image]
-                archive_info[vm[0]][backupset][dev]['images'][new_interval_name][0] = new_filename
-                img_rebase(args.backup_dir + '/' + archive_info[vm[0]][backupset][dev]['images'][interval_name][lowest_image-1], args.backup_dir, new_filename)
-                if 1 in archive_info[vm[0]][backupset][dev]['images'][new_interval_name]:
-                    img_rebase(args.backup_dir + '/' + new_filename, args.backup_dir, archive_info[vm[0]][backupset][dev]['images'][new_interval_name][1])
-            else:
-                img_rotate_interval(vm[0], active_backupset, interval, dev, vm_info, args)
+        steps = backup_steps(vm[0], args)
+        vm_rotate_backups(vm[0], vm[1], active_backupset, vm_info, steps, args)
 
-        if interval == 0:
+        if steps[-1][0] == 'rotate' and args.dry_run:
+            print('%s %s: create incremental backup' % (vm[0], ','.join(vm[1])))
+        elif steps[-1][0] == 'rotate':
             # create incremental snapshot
-            vm_trim(libvirt_conn, vm[0])
+            vm_trim(libvirt_conn, vm[0], vm_info, args)
             vm_snapshot(libvirt_conn, vm[0], vm_info, blockdevs, vm[1], active_backupset, args)
             vm_commit_first(libvirt_conn, vm[0], vm_info, vm[1], args)
+            vm_recompress(vm[0], dict((dev, vm_info[dev]['recompress']) for dev in vm[1] if 'recompress' in vm_info[dev]), args)
+        if not args.dry_run:
+            state_record(vm[0], [args.intervals[step[1]][0] for step in steps], args)
 
-def init_archive_info(args):
+def init_archive_info(args, domains=None):
+    # the daemon rescans only after changes or for domains it did not scan
+    watched = archive_watch is not None and archive_watch['dir'] == os.path.abspath(args.backup_dir)
+    if watched and not archive_watch['changed'].is_set():
+        if archive_watch['domains'] is None or (domains is not None and set(domains) <= archive_watch['domains']):
+            return
+    if watched:
+        if not args.dry_run:
+            archive_watch['changed'].clear()
+        archive_watch['domains'] = None if domains is None else set(domains)
+    try:
+        with report_phase(None, 'scan'):
+            index_load(args)
+            if not args.dry_run:
+                chunk_store_collect(args)
+            scan_archive(args, domains)
+    except Exception:
+        if watched:
+            archive_watch['changed'].set()
+        raise
+
+def scan_archive(args, domains=None):
+    # only the given domains, other runs may rotate the images of the others
     backup_path = Path(args.backup_dir)
     if not backup_path.exists():
         raise NotADirectoryError('Backup path not found')
 
-    for image in backup_path.glob('*.img'):
-        if not image.is_file():
-            continue
+    info = {}
+    # newest images first, so their chains cover the older images of the backupset
+    images = [image for image in backup_path.glob('*.img') if image.is_file() and (domains is None or image.name.split('.')[0] in domains)]
+    images.sort(key=lambda image: int(image.name.split('.')[3].split('-')[-1][1:]) if len(image.name.split('.')) == 7 else -1, reverse=True)
+
+    for image in images:
 
         imgdata = image.name.split('.')
         # 0: domain name, 1: b<nr>, 2: <drive>, 3: i<nr>[-<nr>] | base, 4: <interval>, 5: <nr>, 6: img
@@ -412,45 +1616,832 @@ def init_archive_info(args):
             interval = imgdata[4]
             nr = int(imgdata[5])
 
-        if not domain in archive_info:
-            archive_info[domain] = {}
-        if not backupset in archive_info[domain]:
-            archive_info[domain][backupset] = {}
-        if not drive in archive_info[domain][backupset]:
-            archive_info[domain][backupset][drive] = {'intervals':[], 'images':{}, 'image_count':0, 'chain': []}
+        try:
+            snapshot_chain = get_snapshot_chain(args.backup_dir + '/' + image.name)
+        except Exception:
+            # renamed or deleted by a rotation since the listing
+            if image.exists():
+                raise
+            continue
+
+        if not domain in info:
+            info[domain] = {}
+        if not backupset in info[domain]:
+            info[domain][backupset] = {}
+        if not drive in info[domain][backupset]:
+            info[domain][backupset][drive] = {'intervals':[], 'images':{}, 'image_count':0, 'chain': []}
         if interval != 'base':
-            if not interval in archive_info[domain][backupset][drive]['intervals']:
-                archive_info[domain][backupset][drive]['intervals'].append(interval)
-            if not interval in archive_info[domain][backupset][drive]['images']:
-                archive_info[domain][backupset][drive]['images'][interval] = {}
-            archive_info[domain][backupset][drive]['images'][interval][nr] = image.name
-        if not interval in archive_info[domain][backupset][drive]['images']:
-            archive_info[domain][backupset][drive]['images'][interval] = []
-        archive_info[domain][backupset][drive]['image_count'] += 1
-
-        snapshot_chain = get_snapshot_chain(args.backup_dir + '/' + image.name)
-        if len(snapshot_chain) > len(archive_info[domain][backupset][drive]['chain']):
-            archive_info[domain][backupset][drive]['chain'] = snapshot_chain
-
-        backing_file = get_backing_file(args.backup_dir + '/' + image.name)
-        if interval == 'base' and backing_file != '':
+            if not interval in info[domain][backupset][drive]['intervals']:
+                info[domain][backupset][drive]['intervals'].append(interval)
+            if not interval in info[domain][backupset][drive]['images']:
+                info[domain][backupset][drive]['images'][interval] = {}
+            info[domain][backupset][drive]['images'][interval][nr] = image.name
+        if not interval in info[domain][backupset][drive]['images']:
+            info[domain][backupset][drive]['images'][interval] = []
+        info[domain][backupset][drive]['image_count'] += 1
+
+        if len(snapshot_chain) > len(info[domain][backupset][drive]['chain']):
+            info[domain][backupset][drive]['chain'] = snapshot_chain
+
+        if interval == 'base' and len(snapshot_chain) > 1:
             raise ValueError('The base image ' + image.name + ' must not have a backing file')
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Backup virtual machines.')
+    # the entries of the other domains stay, a worker rescans its domain while the others run
+    if domains is None:
+        archive_info.clear()
+    for domain in domains or []:
+        archive_info.pop(domain, None)
+    archive_info.update(info)
+    index_save()
+
+def worker_connection():
+    # the daemon keeps the connections and outlives restarts of libvirtd
+    if hasattr(worker_local, 'conn') and not worker_local.conn.isAlive():
+        with worker_connections_lock:
+            worker_connections.remove(worker_local.conn)
+        del worker_local.conn
+    if not hasattr(worker_local, 'conn'):
+        #connect to hypervisor running on localhost
+        worker_local.conn = libvirt.open('qemu:///system')
+        with worker_connections_lock:
+            worker_connections.append(worker_local.conn)
+    return worker_local.conn
+
+def domain_args(args, vm_name):
+    domain_args = copy.copy(args)
+    for key, value in args.domain_config.get(vm_name, {}).items():
+        if not key in DOMAIN_CONFIG_KEYS:
+            raise ValueError('Invalid option in domain config for ' + vm_name + ': ' + key)
+        # JSON numbers may be integers for float options, mountpoints may be a list
+        default = getattr(args, key)
+        if not isinstance(value, type(default)) and not (isinstance(default, float) and isinstance(value, int)) and not (key == 'freeze_mountpoints' and isinstance(value, list)):
+            raise ValueError('Invalid value in domain config for ' + vm_name + ': ' + key + ' must be of type ' + type(default).__name__)
+        setattr(domain_args, key, value)
+    try:
+        check_options(domain_args)
+    except ValueError as e:
+        raise ValueError('Invalid domain config for ' + vm_name + ': ' + str(e))
+    return domain_args
+
+def domain_lock_path(vm_name):
+    return '/tmp/qemu-backup.' + vm_name + '.lock'
+
+def replica_open(url, args):
+    # ssh://[user@]host[:port]/path, s3://bucket/prefix or a local path, e.g. a mounted NFS share
+    match = re.match(r'^(ssh|s3)://([^/]+)(/.*)?$', url)
+    if match is None:
+        return { 'scheme': 'file', 'path': url[7:] if url.startswith('file://') else url }
+    if match.group(1) == 'ssh':
+        host = match.group(2).split(':')
+        return { 'scheme': 'ssh', 'host': host[0], 'port': host[1] if len(host) > 1 else '', 'path': match.group(3) or '.' }
+    try:
+        import boto3
+    except ImportError:
+        raise Exception('boto3 is required for s3 replicas')
+    client = boto3.client('s3', endpoint_url=args.replica_endpoint or None)
+    return { 'scheme': 's3', 'client': client, 'bucket': match.group(2), 'prefix': (match.group(3) or '').strip('/') }
+
+def replica_path(replica, name):
+    if replica['scheme'] == 's3':
+        return replica['prefix'] + '/' + name if replica['prefix'] else name
+    return replica['path'] + '/' + name
+
+def replica_ssh(replica, command, **kwargs):
+    # one connection is shared by all commands of a sync
+    cmd = ['ssh', '-o', 'BatchMode=yes', '-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/qemu-backup-ssh-%C', '-o', 'ControlPersist=60']
+    if replica['port']:
+        cmd += ['-p', replica['port']]
+    info_output = run_command(cmd + [replica['host'], command], **kwargs)
+    if info_output.returncode != 0:
+        raise Exception('Error running ' + command + ' on ' + replica['host'])
+    return info_output
+
+def replica_size(replica, name):
+    # size of a partial upload, -1 if there is none
+    path = replica_path(replica, name)
+    if replica['scheme'] == 'file':
+        return os.stat(path).st_size if os.path.exists(path) else -1
+    return int(replica_ssh(replica, 'stat -c %%s %s 2>/dev/null || echo -1' % (shlex.quote(path)), stdout=subprocess.PIPE, universal_newlines=True).stdout)
+
+def replica_put_s3(replica, image, name, upload, save):
+    # multipart upload, the finished parts are kept in the replica state so
+    # an interrupted upload continues with the next part
+    client = replica['client']
+    size = os.stat(image).st_size
+    key = replica_path(replica, name)
+    if not 'upload_id' in upload:
+        # at most 9000 of the 10000 parts s3 allows, in whole MiB
+        part_size = -(-size // 9000)
+        upload['part_size'] = max(REPLICA_PART_SIZE, -(-part_size // COPY_CHUNK_SIZE) * COPY_CHUNK_SIZE)
+        upload['upload_id'] = client.create_multipart_upload(Bucket=replica['bucket'], Key=key)['UploadId']
+        upload['parts'] = []
+        save()
+    with open(image, 'rb') as f:
+        while len(upload['parts']) * upload['part_size'] < size or len(upload['parts']) == 0:
+            number = len(upload['parts']) + 1
+            data = os.pread(f.fileno(), upload['part_size'], (number - 1) * upload['part_size'])
+            etag = client.upload_part(Bucket=replica['bucket'], Key=key, UploadId=upload['upload_id'], PartNumber=number, Body=data)['ETag']
+            upload['parts'].append({ 'PartNumber': number, 'ETag': etag })
+            save()
+    client.complete_multipart_upload(Bucket=replica['bucket'], Key=key, UploadId=upload['upload_id'], MultipartUpload={ 'Parts': upload['parts'] })
+
+def replica_put(replica, image, name, upload, save):
+    # streamed into name.part, appended to a partial upload of the same
+    # local file, and renamed once complete
+    if replica['scheme'] == 's3':
+        return replica_put_s3(replica, image, name, upload, save)
+    offset = max(replica_size(replica, name + '.part'), 0) if upload.get('started') else 0
+    upload['started'] = True
+    save()
+    part = replica_path(replica, name + '.part')
+    with open(image, 'rb') as f:
+        f.seek(offset)
+        if replica['scheme'] == 'file':
+            with open(part, 'ab' if offset > 0 else 'wb') as fdst:
+                shutil.copyfileobj(f, fdst, COPY_CHUNK_SIZE)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+        else:
+            replica_ssh(replica, 'cat %s %s' % ('>>' if offset > 0 else '>', shlex.quote(part)), stdin=f, stdout=subprocess.PIPE)
+    if replica_size(replica, name + '.part') != os.stat(image).st_size:
+        raise Exception('Incomplete upload of ' + name)
+    replica_rename(replica, name + '.part', name)
+
+def replica_rename(replica, old_name, new_name):
+    if replica['scheme'] == 'file':
+        os.rename(replica_path(replica, old_name), replica_path(replica, new_name))
+    elif replica['scheme'] == 'ssh':
+        replica_ssh(replica, 'mv %s %s' % (shlex.quote(replica_path(replica, old_name)), shlex.quote(replica_path(replica, new_name))))
+    else:
+        # server side copy, in parts for large objects
+        replica['client'].copy({ 'Bucket': replica['bucket'], 'Key': replica_path(replica, old_name) }, replica['bucket'], replica_path(replica, new_name))
+        replica_delete(replica, old_name)
+
+def replica_delete(replica, name):
+    if replica['scheme'] == 'file':
+        if os.path.exists(replica_path(replica, name)):
+            os.unlink(replica_path(replica, name))
+    elif replica['scheme'] == 'ssh':
+        replica_ssh(replica, 'rm -f %s' % (shlex.quote(replica_path(replica, name))))
+    else:
+        replica['client'].delete_object(Bucket=replica['bucket'], Key=replica_path(replica, name))
+
+def replica_patch_head(replica, image, name, head_hash):
+    # a rebase only rewrites the header, objects cannot be patched, a
+    # header that does not arrive intact is uploaded with the image
+    with open(image, 'rb') as f:
+        head = f.read(REPLICA_HEAD_SIZE)
+    if hashlib.sha256(head).hexdigest() != head_hash:
+        return False
+    if replica['scheme'] == 'file':
+        with open(replica_path(replica, name), 'r+b') as f:
+            os.pwrite(f.fileno(), head, 0)
+            os.fsync(f.fileno())
+    elif replica['scheme'] == 'ssh':
+        path = shlex.quote(replica_path(replica, name))
+        # without fullblock dd writes what one read of the pipe returns
+        replica_ssh(replica, 'dd of=%s bs=%d count=1 iflag=fullblock conv=notrunc status=none' % (path, len(head)), input=head, stdout=subprocess.PIPE)
+        if replica_ssh(replica, 'head -c %d %s | sha256sum' % (len(head), path), stdout=subprocess.PIPE, universal_newlines=True).stdout.split(' ')[0] != head_hash:
+            print('Warning: header of ' + name + ' on the replica does not match, uploading it again')
+            return False
+    else:
+        return False
+    return True
+
+def replica_hashes(image):
+    # the header and the rest are hashed apart, so a rebased image is
+    # recognized and only its header is sent again
+    entry = index_lookup(image)
+    if entry is not None and 'replica' in entry and entry['replica']['key'] == entry['key']:
+        return entry['replica']
+    stat = os.stat(image)
+    head = hashlib.sha256()
+    body = hashlib.sha256()
+    buf = bytearray(CHECKSUM_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(image, 'rb', buffering=0) as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        head.update(f.read(REPLICA_HEAD_SIZE))
+        while True:
+            length = f.readinto(buf)
+            if not length:
+                break
+            body.update(view[:length])
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    hashes = { 'key': index_key(stat), 'size': stat.st_size, 'head': head.hexdigest(), 'body': body.hexdigest() }
+    if entry is None:
+        index_remove(image)
+    index_update(image, replica=hashes)
+    return hashes
+
+def replica_sync(vm_name, args):
+    # mirror the images of a domain to the replica: renamed images are
+    # renamed there, rebased images get their new header, only new and
+    # changed images are uploaded
+    replica = replica_open(args.replica, args)
+    state_path = args.backup_dir + '/.qemu-backup-replica.' + vm_name + '.json'
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+    if state.get('url') != args.replica:
+        state = { 'url': args.replica, 'images': {}, 'uploads': {} }
+    def save():
+        journal_write(state_path, state)
+
+    thin_images = chunk_store_thin_images(args)
+    local = {}
+    for image in sorted(Path(args.backup_dir).glob(vm_name + '.*.img')):
+        if image.name.split('.')[0] != vm_name:
+            continue
+        if image.name in thin_images:
+            print('Not replicating thin image ' + image.name + ', materialize it first')
+            continue
+        local[image.name] = replica_hashes(image.as_posix())
+    local = dict((name, { 'size': hashes['size'], 'head': hashes['head'], 'body': hashes['body'] }) for name, hashes in local.items())
+    remote = state['images']
+
+    # images with the wrong contents for their name, they are moved where they belong or removed
+    spare = dict((name, entry) for name, entry in remote.items() if not name in local or (entry['size'], entry['body']) != (local[name]['size'], local[name]['body']))
+    moves = []
+    for name, entry in local.items():
+        if name in remote and not name in spare:
+            continue
+        for spare_name, spare_entry in spare.items():
+            if (spare_entry['size'], spare_entry['body']) == (entry['size'], entry['body']) and not spare_name in [move[0] for move in moves]:
+                moves.append((spare_name, name))
+                break
+    for name in spare:
+        if not name in [move[0] for move in moves]:
+            replica_delete(replica, name)
+            del remote[name]
+            save()
+    # move into names that are freed up by earlier moves only
+    while len(moves) > 0:
+        ready = [move for move in moves if not move[1] in remote]
+        if len(ready) == 0:
+            raise Exception('Cannot order renames on the replica of ' + vm_name)
+        for old_name, new_name in ready:
+            replica_rename(replica, old_name, new_name)
+            remote[new_name] = remote.pop(old_name)
+            save()
+        moves = [move for move in moves if not move in ready]
+
+    for name, entry in sorted(local.items()):
+        if remote.get(name) == entry:
+            continue
+        if name in remote and (remote[name]['size'], remote[name]['body']) == (entry['size'], entry['body']):
+            if replica_patch_head(replica, args.backup_dir + '/' + name, name, entry['head']):
+                remote[name] = entry
+                save()
+                continue
+        upload = state['uploads'].get(name, {})
+        if upload.get('key') != entry:
+            if 'upload_id' in upload:
+                replica['client'].abort_multipart_upload(Bucket=replica['bucket'], Key=replica_path(replica, name), UploadId=upload['upload_id'])
+            upload = { 'key': entry }
+        state['uploads'][name] = upload
+        replica_put(replica, args.backup_dir + '/' + name, name, upload, save)
+        del state['uploads'][name]
+        remote[name] = entry
+        report_add(vm_name, None, 'bytes_replicated', entry['size'])
+        save()
+
+def domain_backup(vms, args):
+    report_local.domain = vms[0][0]
+    lock = lock_acquire(domain_lock_path(vms[0][0]))
+    if lock is None:
+        print('another instance is running for domain ' + vms[0][0])
+        report_set(vms[0][0], 'status', 'locked')
+        return False
+    start = time.monotonic()
+    try:
+        # another run may have rotated the images since the scan of this
+        # run, the lock keeps them unchanged from here on
+        if not args.dry_run:
+            journal_replay(vms[0][0], args)
+        with report_phase(vms[0][0], 'scan'):
+            scan_archive(args, [vms[0][0]])
+        for vm in vms:
+            vm_backup(worker_connection(), vm, domain_args(args, vm[0]))
+        replica_args = domain_args(args, vms[0][0])
+        if replica_args.replica and not args.dry_run:
+            with report_phase(vms[0][0], 'replica'):
+                replica_sync(vms[0][0], replica_args)
+        report_set(vms[0][0], 'status', 'ok')
+        return True
+    except (Exception, SystemExit) as e:
+        print('Backup of domain ' + vms[0][0] + ' failed: ' + str(e))
+        report_set(vms[0][0], 'status', 'failed')
+        report_set(vms[0][0], 'error', str(e))
+        return False
+    finally:
+        report_set(vms[0][0], 'duration', time.monotonic() - start)
+        lock_release(lock)
+
+def history_read(args):
+    try:
+        with open(args.backup_dir + '/' + HISTORY_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def history_record(args):
+    # bytes written and duration of the last successful runs per domain
+    lock = lock_acquire(args.backup_dir + '/' + HISTORY_FILE + '.lock', True)
+    try:
+        history = history_read(args)
+        for vm_name, domain in run_report['domains'].items():
+            if domain.get('status') != 'ok':
+                continue
+            written = sum(drive['bytes_written'] for drive in domain['drives'].values())
+            history[vm_name] = (history.get(vm_name, []) + [{ 'bytes': written, 'seconds': domain['duration'] }])[-10:]
+        tmp_path = args.backup_dir + '/' + HISTORY_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(history, f)
+        os.replace(tmp_path, args.backup_dir + '/' + HISTORY_FILE)
+    finally:
+        if lock is not None:
+            lock_release(lock)
+
+def img_measure(image):
+    cmd = ['qemu-img', 'measure', '--output=json', '-O', 'qcow2']
+    if not omit_unsafe:
+        cmd.append('-U')
+    info_output = run_command(cmd + [image], stdout=subprocess.PIPE, universal_newlines=True)
+    if info_output.returncode != 0:
+        raise Exception('Could not measure ' + image)
+    return json.loads(info_output.stdout)['required']
+
+def preflight_domain(libvirt_conn, vms, history, args):
+    # upper bound of the bytes a backup of the domain adds to the backup
+    # dir, compression and deduplication are not taken into account
+    vm_name = vms[0][0]
+    args = domain_args(args, vm_name)
+    blockdevs = vm_get_blockdevs(libvirt_conn, vm_name)
+    checkpoint = None
+    if args.engine == 'bitmap':
+        checkpoint = vm_get_checkpoint(libvirt_conn.lookupByName(vm_name))
+    steps = backup_steps(vm_name, args)
+    estimate = 0
+    for vm in vms:
+        for dev in (vm[1] if len(vm) > 1 else blockdevs):
+            if not dev in blockdevs:
+                continue # reported by the backup
+            chain = get_snapshot_chain(blockdevs[dev])
+            if args.new_chain or (args.engine == 'snapshot' and len(chain) != 2) or (args.engine == 'bitmap' and (checkpoint is None or len(chain) > 1)):
+                estimate += img_measure(chain[0])
+                continue
+            if args.engine == 'snapshot':
+                backupset = chain[0].split('.')[-3]
+                if steps[-1][0] == 'rotate':
+                    # the new incremental holds what the overlay has allocated
+                    estimate += os.stat(chain[0]).st_blocks * 512
+            else:
+                backupset = "b%03d" % (checkpoint[0])
+                if steps[-1][0] == 'rotate' and len(history.get(vm_name, [])) > 0:
+                    # the dirty bitmap cannot be measured, assume the size of the last run
+                    estimate += history[vm_name][-1]['bytes'] // max(len(blockdevs), 1)
+            if backupset in archive_info.get(vm_name, {}) and dev in archive_info[vm_name][backupset]:
+                # a commit grows its base by at most the merged images until they are removed
+                ops, new_images = rotation_plan(vm_name, backupset, dev, steps, args)
+                estimate += sum(os.stat(args.backup_dir + '/' + op[1]).st_blocks * 512 for op in ops if op[0] == 'unlink')
+    return estimate
+
+def preflight(domains, args):
+    # estimate bytes and duration of every domain, then check them
+    # against the free space of the backup dir and the time budget
+    history = history_read(args)
+    total_bytes = sum(entry['bytes'] for entries in history.values() for entry in entries)
+    total_seconds = sum(entry['seconds'] for entries in history.values() for entry in entries)
+    estimates = {}
+    for vm_name, vms in domains.items():
+        try:
+            estimates[vm_name] = preflight_domain(worker_connection(), vms, history, args)
+        except (Exception, SystemExit) as e:
+            print('Cannot estimate the backup of ' + vm_name + ': ' + str(e))
+            estimates[vm_name] = 0
+    predicted = {}
+    for vm_name, estimate in estimates.items():
+        entries = history.get(vm_name, [])
+        domain_bytes = sum(entry['bytes'] for entry in entries)
+        domain_seconds = sum(entry['seconds'] for entry in entries)
+        if domain_bytes > 0:
+            predicted[vm_name] = estimate * domain_seconds / domain_bytes
+        elif total_bytes > 0:
+            predicted[vm_name] = estimate * total_seconds / total_bytes
+        elif len(entries) > 0:
+            predicted[vm_name] = domain_seconds / len(entries)
+        else:
+            predicted[vm_name] = None
+
+    free = shutil.disk_usage(args.backup_dir).free - int(args.preflight_reserve * 1024**3)
+    run_report['preflight'] = { 'free': free, 'bytes': estimates, 'seconds': predicted, 'skipped': [] }
+    for vm_name in sorted(estimates):
+        if verbose or args.preflight == 'report':
+            print('%s: up to %.1f GiB, %s' % (vm_name, estimates[vm_name] / 1024**3, 'about %d seconds' % (predicted[vm_name]) if predicted[vm_name] is not None else 'no history yet'))
+    total = sum(estimates.values())
+    duration = sum(seconds or 0 for seconds in predicted.values()) / args.jobs
+    over_budget = total > free or (args.time_budget > 0 and duration > args.time_budget)
+    if over_budget or verbose or args.preflight == 'report':
+        print('Estimate: up to %.1f GiB of %.1f GiB free, about %d seconds' % (total / 1024**3, max(free, 0) / 1024**3, duration))
+
+    if not over_budget or args.preflight == 'report':
+        return list(domains)
+    if args.preflight == 'abort':
+        raise Exception('The backup does not fit into the free space of the backup dir or the time budget')
+
+    # fit: as many domains as possible, the smallest first
+    selected = []
+    time_budget = args.time_budget
+    for vm_name in sorted(domains, key=lambda vm_name: estimates[vm_name]):
+        seconds = (predicted[vm_name] or 0) / args.jobs
+        if estimates[vm_name] <= free and (args.time_budget <= 0 or seconds <= time_budget):
+            selected.append(vm_name)
+            free -= estimates[vm_name]
+            time_budget -= seconds
+        else:
+            print('Skipping ' + vm_name + ', it does not fit into the free space or the time budget')
+            run_report['preflight']['skipped'].append(vm_name)
+    return selected
+
+def verify_image(image, thin, args):
+    # unchanged images with a checksum are only read again with --full
+    entry = index_lookup(image)
+    if img_checksum_valid(entry) and not args.full:
+        return 'skipped', []
+    problems = []
+    # the metadata of thin images is not complete until they are materialized
+    if not thin:
+        info_output = run_command(['qemu-img', 'check', '-f', 'qcow2', '--output=json', image], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        # 3 means leaked clusters only, they waste space but lose no data
+        if not info_output.returncode in [0, 3]:
+            problems.append('qemu-img check failed with exit code %d' % (info_output.returncode))
+    stat = os.stat(image)
+    digest = img_checksum(image)
+    if img_checksum_valid(entry) and entry['checksum']['sha256'] != digest:
+        problems.append('checksum mismatch')
+    if len(problems) > 0:
+        return 'failed', problems
+    if entry is None:
+        index_remove(image) # cached info may be outdated as well
+    index_update(image, checksum={ 'key': index_key(stat), 'sha256': digest, 'time': int(time.time()) })
+    return 'verified' if img_checksum_valid(entry) else 'hashed', []
+
+def verify_pack(args, pack):
+    # the chunks are read in the order they were written
+    problems = []
+    db = chunk_store_open(args)
+    try:
+        with open(chunk_pack_path(args, pack), 'rb') as f:
+            for digest, offset, length in db.execute('SELECT hash, offset, size FROM chunks WHERE pack = ? ORDER BY offset', (pack,)):
+                if hashlib.sha256(os.pread(f.fileno(), length, offset)).hexdigest() != digest:
+                    problems.append('checksum mismatch of chunk ' + digest)
+    finally:
+        db.close()
+    return 'failed' if len(problems) > 0 else 'verified', problems
+
+def verify_results(futures, results):
+    # counts the results, prints the problems and returns the number of failed images
+    failed = 0
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            result, problems = future.result()
+        except Exception as e:
+            result, problems = 'failed', [str(e)]
+        results[result] = results.get(result, 0) + 1
+        if len(problems) > 0:
+            failed += 1
+            print(futures[future] + ': ' + ', '.join(problems))
+        elif verbose:
+            print(futures[future] + ': ' + result)
+    return failed
+
+def verify(argv, job=None):
+    global verbose
+    parser = argparse.ArgumentParser(prog='qemu-backup.py verify', description='Verify the images in the backup dir.')
+    parser.add_argument('domains', metavar='DOM', nargs='*', help='domains to verify (default: all)')
+    parser.add_argument('--backup-dir', dest='backup_dir', action='store', default='/var/vmbackup', help='Backup directory (default: /var/vmbackup)')
+    parser.add_argument('--full', dest='full', action='store_true', default=False, help='check and hash all images and chunks, not only new and changed ones (default: no)')
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int, default=os.cpu_count() or 1, help='number of images to verify concurrently (default: number of CPUs)')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='print the result for every image (default: no)')
+    if job is not None:
+        job_parser(parser)
+    args = parser.parse_args(argv)
+    if job is not None:
+        job_paths(args, job)
+    args.dry_run = False
+    args.rebuild_index = False
+    # resumed rotations run unthrottled
+    args.bandwidth = args.total_bandwidth = 0
+    args.throttle_hours = args.ionice = args.cgroup = ''
+    verbose = args.verbose
+
+    if args.jobs <= 0:
+        raise ValueError('Number of jobs must be positive.')
+
+    # every domain is scanned and checked while its lock is held, backups of
+    # the other domains can run meanwhile
+    domains = args.domains or sorted(set(image.name.split('.')[0] for image in Path(args.backup_dir).glob('*.img')))
+    thin_images = chunk_store_thin_images(args)
+    results = {}
+    failed = 0
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            for vm_name in domains:
+                # rotation must not change the images while they are read
+                lock = lock_acquire(domain_lock_path(vm_name))
+                if lock is None:
+                    print('another instance is running for domain ' + vm_name + ', skipped')
+                    continue
+                try:
+                    # a half rotated chain is not verified
+                    try:
+                        journal_replay(vm_name, args)
+                    except Exception as e:
+                        print(str(e) + ', ' + vm_name + ' skipped')
+                        failed += 1
+                        continue
+                    init_archive_info(args, [vm_name])
+                    if not vm_name in archive_info:
+                        raise LookupError('No backups found for domain ' + vm_name)
+                    images = []
+                    for backupset, drives in sorted(archive_info[vm_name].items()):
+                        for dev, drive in sorted(drives.items()):
+                            for interval_name, interval_images in drive['images'].items():
+                                if interval_name == 'base':
+                                    images.append("%s.%s.%s.base.img" % (vm_name, backupset, dev))
+                                else:
+                                    images += interval_images.values()
+                    failed += verify_results({executor.submit(verify_image, args.backup_dir + '/' + name, name in thin_images, args): name for name in images}, results)
+                finally:
+                    # the next scan reloads the index
+                    index_save()
+                    lock_release(lock)
+            if args.full:
+                failed += verify_results({executor.submit(verify_pack, args, pack): CHUNK_STORE_DIR + '/%d.pack' % (pack) for pack in chunk_store_packs(args)}, results)
+    finally:
+        index_save()
+
+    print('%d verified, %d hashed for the first time, %d unchanged, %d failed' % (results.get('verified', 0), results.get('hashed', 0), results.get('skipped', 0), failed))
+    return 1 if failed > 0 else 0
+
+def restore_points(vm_name, dev, args):
+    # every image of the drive in any backupset, newest contents last
+    points = []
+    for backupset, drives in archive_info.get(vm_name, {}).items():
+        if not dev in drives:
+            continue
+        for interval_name, images in drives[dev]['images'].items():
+            if interval_name == 'base':
+                points.append(("%s.%s.%s.base.img" % (vm_name, backupset, dev), backupset, 'base'))
+                continue
+            for i, filename in images.items():
+                points.append((filename, backupset, '%s.%d' % (interval_name, i)))
+    return sorted(points, key=lambda point: os.stat(args.backup_dir + '/' + point[0]).st_mtime)
+
+def restore_find_image(vm_name, dev, args):
+    points = restore_points(vm_name, dev, args)
+    if len(points) == 0:
+        raise LookupError('No backup images found for ' + vm_name + ' ' + dev)
+    if args.at:
+        at = datetime.datetime.fromisoformat(args.at)
+        if len(args.at) == 10:
+            at += datetime.timedelta(days=1) # a date includes the whole day
+        points = [point for point in points if os.stat(args.backup_dir + '/' + point[0]).st_mtime <= at.timestamp()]
+        if len(points) == 0:
+            raise LookupError('No backup of ' + vm_name + ' ' + dev + ' before ' + args.at)
+        return points[-1][0]
+    backupset = args.backupset or max(point[1] for point in points)
+    points = [point for point in points if point[1] == backupset]
+    if len(points) > 0 and args.point == '':
+        # a new chain has only its base image
+        return points[-1][0]
+    for filename, point_backupset, point in points:
+        if args.point in [point, filename]:
+            return filename
+    if args.point == '':
+        raise LookupError('No backup images in backupset ' + backupset + ' of ' + vm_name + ' ' + dev)
+    raise LookupError('No backup image ' + args.point + ' in backupset ' + backupset + ' of ' + vm_name + ' ' + dev)
+
+def restore_history_read(args):
+    try:
+        with open(args.backup_dir + '/' + RESTORE_HISTORY_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def restore_history_add(args, read_bytes, seconds):
+    history = (restore_history_read(args) + [{ 'bytes': read_bytes, 'seconds': seconds }])[-20:]
+    tmp_path = args.backup_dir + '/' + RESTORE_HISTORY_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f)
+    os.replace(tmp_path, args.backup_dir + '/' + RESTORE_HISTORY_FILE)
+
+def restore_estimate(chain, args):
+    # convert reads the allocated data of every layer, the throughput is
+    # taken from earlier restores or sampled from the chain
+    read_bytes = sum(os.stat(image).st_blocks * 512 for image in chain)
+    history = restore_history_read(args)
+    if len(history) > 0:
+        throughput = sum(entry['bytes'] for entry in history) / max(sum(entry['seconds'] for entry in history), 0.001)
+    else:
+        sampled = 0
+        start = time.monotonic()
+        for image in sorted(chain, key=lambda image: os.stat(image).st_size, reverse=True):
+            with open(image, 'rb') as f:
+                while sampled < RESTORE_SAMPLE_SIZE:
+                    data = f.read(COPY_CHUNK_SIZE)
+                    if len(data) == 0:
+                        break
+                    sampled += len(data)
+            if sampled >= RESTORE_SAMPLE_SIZE:
+                break
+        throughput = sampled / max(time.monotonic() - start, 0.001)
+    return read_bytes, read_bytes / max(throughput, 1)
+
+def restore(argv, job=None):
+    parser = argparse.ArgumentParser(prog='qemu-backup.py restore', description='Restore a drive from the backup dir.')
+    parser.add_argument('domain', metavar='DOM:drive', help='domain and drive to restore, the drive can be omitted for domains with one drive')
+    parser.add_argument('output', nargs='?', default='', help='image to write, must not exist')
+    parser.add_argument('--backup-dir', dest='backup_dir', action='store', default='/var/vmbackup', help='Backup directory (default: /var/vmbackup)')
+    parser.add_argument('--backupset', dest='backupset', action='store', default='', help='backupset to restore from, e.g. b001 (default: newest)')
+    parser.add_argument('--point', dest='point', action='store', default='', help='image to restore as interval.index, base or its file name (default: the newest of the backupset)')
+    parser.add_argument('--at', dest='at', action='store', default='', help='restore the newest backup taken until this ISO date or time, a date includes the whole day, overrides --point and --backupset (default: none)')
+    parser.add_argument('--overlay', dest='overlay', action='store_true', default=False, help='create a qcow2 overlay backed by the backup chain instead of a flattened image, the chain must stay unchanged while it is used (default: no)')
+    parser.add_argument('--format', dest='format', action='store', choices=['qcow2', 'raw'], default='qcow2', help='format of the flattened image (default: qcow2)')
+    parser.add_argument('--estimate', dest='estimate', action='store_true', default=False, help='only print how long the restore would take (default: no)')
+    parser.add_argument('--list', dest='list', action='store_true', default=False, help='list the backups of the drive and exit (default: no)')
+    parser.add_argument('--convert-coroutines', dest='convert_coroutines', action='store', type=int, default=8, help='number of parallel coroutines for qemu-img convert, passed as -m (default: 8)')
+    parser.add_argument('--convert-out-of-order', dest='convert_out_of_order', action='store_true', default=False, help='allow out of order writes in qemu-img convert, passed as -W (default: no)')
+    parser.add_argument('--convert-cache', dest='convert_cache', action='store', default='', help='cache mode for the written image in qemu-img convert, passed as -t, e.g. none (default: qemu-img default)')
+    parser.add_argument('--convert-source-cache', dest='convert_source_cache', action='store', default='', help='cache mode for the source image in qemu-img convert, passed as -T, e.g. none (default: qemu-img default)')
+    parser.add_argument('--rebuild-index', dest='rebuild_index', action='store_true', default=False, help='ignore the image index in the backup dir and rescan all images (default: no)')
+    if job is not None:
+        job_parser(parser)
+    args = parser.parse_args(argv)
+    if job is not None:
+        job_paths(args, job)
+    args.dry_run = False
+    args.compression = 'none'
+    # resumed rotations run unthrottled
+    args.bandwidth = args.total_bandwidth = 0
+    args.throttle_hours = args.ionice = args.cgroup = ''
+
+    if args.convert_coroutines < 1 or args.convert_coroutines > 16:
+        raise ValueError('Number of coroutines must be between 1 and 16.')
+    if not args.list and args.output == '':
+        parser.error('the output image is required')
+    if args.output and os.path.exists(args.output):
+        raise ValueError(args.output + ' already exists')
+
+    # rotation must not change the chain while it is listed or read
+    domain = args.domain.split(':')
+    lock = lock_acquire(domain_lock_path(domain[0]))
+    if lock is None:
+        print('another instance is running for domain ' + domain[0])
+        return 1
+    try:
+        journal_replay(domain[0], args)
+        init_archive_info(args, [domain[0]])
+        if not domain[0] in archive_info:
+            raise LookupError('No backups found for domain ' + domain[0])
+        if len(domain) == 1:
+            drives = set(dev for drives in archive_info[domain[0]].values() for dev in drives)
+            if len(drives) != 1:
+                raise ValueError('Domain ' + domain[0] + ' has several drives, please choose one of ' + ', '.join(sorted(drives)))
+            domain.append(drives.pop())
+        vm_name, dev = domain[0], domain[1]
+
+        if args.list:
+            for filename, backupset, point in restore_points(vm_name, dev, args):
+                print('%s  %-4s %-12s %s' % (datetime.datetime.fromtimestamp(os.stat(args.backup_dir + '/' + filename).st_mtime).strftime('%Y-%m-%d %H:%M'), backupset, point, filename))
+            return 0
+
+        image = args.backup_dir + '/' + restore_find_image(vm_name, dev, args)
+        chain = get_snapshot_chain(image)
+        if args.overlay:
+            print('Restoring %s as overlay, ready instantly' % (Path(image).name))
+            print('Warning: the next backup of %s renames or merges %s and its backing images, the overlay only works until then unless it is flattened with qemu-img convert' % (vm_name, Path(image).name))
+        else:
+            read_bytes, seconds = restore_estimate(chain, args)
+            print('Restoring %s: %d images, %.1f GiB to read, about %d seconds' % (Path(image).name, len(chain), read_bytes / 1024**3, seconds))
+        if args.estimate:
+            return 0
+
+        # thin base images must hold their data before qemu reads them
+        chunk_store_materialize(chain[-1], args)
+        start = time.monotonic()
+        if args.overlay:
+            cmd = ['qemu-img', 'create', '-f', 'qcow2', '-F', 'qcow2', '-b', os.path.abspath(image), args.output]
+        else:
+            cmd = ['qemu-img', 'convert', '-f', 'qcow2', '-O', args.format] + img_convert_options(args) + [image, args.output]
+        info_output = run_command(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        if info_output.returncode != 0:
+            raise Exception('Error restoring ' + image + ' to ' + args.output)
+        if not args.overlay:
+            restore_history_add(args, read_bytes, time.monotonic() - start)
+            print('Restored %s in %d seconds' % (args.output, time.monotonic() - start))
+    finally:
+        index_save()
+        lock_release(lock)
+    return 0
+
+def backup_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Backup virtual machines.')
     parser.add_argument('domains', metavar='DOM[:drive0,drive1,...]', nargs='+', help='domains to backup (optional: limit to drives)')
     parser.add_argument('--backup-dir', dest='backup_dir', action='store', default='/var/vmbackup', help='Backup directory (default: /var/vmbackup)')
     parser.add_argument('--intervals', dest='intervals', action='store', default='daily:7,weekly:4,monthly,yearly:10', help='Comma separated list of backup intervals and number of backups to keep (default: daily:7,weekly:4,monthly:12,yearly:10)')
     parser.add_argument('--interval', dest='interval', action='store', default='', help='Backup interval (default: lowest)')
+    parser.add_argument('--auto-intervals', dest='auto_intervals', action='store_true', default=False, help='run the promotions of all intervals that are due by the calendar or by the last run and the lowest interval in one run, supports daily, weekly, monthly and yearly (default: no)')
     parser.add_argument('--new-chain', dest='new_chain', action='store_true', default=False, help='create new backup chain (default: no)')
+    parser.add_argument('--engine', dest='engine', action='store', choices=['snapshot', 'bitmap'], default='snapshot', help='snapshot: external snapshots and blockcommit, bitmap: export changed blocks using persistent dirty bitmaps, --copy is ignored and images are compressed after the backup job (default: snapshot)')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False, help='print the planned rotation of the backup images without changing anything (default: no)')
     parser.add_argument('--copy', dest='copy', action='store_true', default=False, help='copy file instead of using qemu-img convert, ignored if compression is enabled (default: no)')
-    parser.add_argument('--compress', dest='compress', action='store_true', default=False, help='use qemu-img convert to compress image files (default: no)')
+    parser.add_argument('--compress', dest='compression', action='store_const', const='zlib', default='none', help='same as --compression zlib')
+    parser.add_argument('--compression', dest='compression', action='store', choices=['none', 'zlib', 'zstd'], default='none', help='compress image files with qemu-img convert using this qcow2 compression type, zstd needs qemu 5.1 (default: none)')
+    parser.add_argument('--compress-deferred', dest='compress_deferred', action='store_true', default=False, help='export incremental images uncompressed and compress them after the domain has committed its overlay, drives are compressed concurrently like --export-jobs (default: no)')
+    parser.add_argument('--export-jobs', dest='export_jobs', action='store', type=int, default=0, help='number of drives of a domain to export concurrently (default: 0, all drives)')
+    parser.add_argument('--convert-coroutines', dest='convert_coroutines', action='store', type=int, default=0, help='number of parallel coroutines for qemu-img convert, passed as -m (default: 0, qemu-img default)')
+    parser.add_argument('--convert-out-of-order', dest='convert_out_of_order', action='store_true', default=False, help='allow out of order writes in qemu-img convert, passed as -W, ignored if compression is enabled (default: no)')
+    parser.add_argument('--convert-cache', dest='convert_cache', action='store', default='', help='cache mode for the written image in qemu-img convert, passed as -t, e.g. none (default: qemu-img default)')
+    parser.add_argument('--convert-source-cache', dest='convert_source_cache', action='store', default='', help='cache mode for the source image in qemu-img convert, passed as -T, e.g. none (default: qemu-img default)')
+    parser.add_argument('--domain-config', dest='domain_config', action='store', default='', help='JSON file with per domain settings overriding the command line, e.g. {"vm1": {"convert_coroutines": 8}}, only the compression, copy, dedup, checksum, export, convert, trim, freeze, bandwidth, ionice, cgroup and replica options (default: none)')
     parser.add_argument('--omit-unsafe', dest='omit_unsafe', action='store_true', default=False, help='do not use -U on qemu-img info (default: no)')
-    args = parser.parse_args()
+    parser.add_argument('--no-trim', dest='no_trim', action='store_true', default=False, help='do not trim guest filesystems before taking a snapshot (default: no)')
+    parser.add_argument('--trim-timeout', dest='trim_timeout', action='store', type=int, default=240, help='maximum number of seconds to wait for the guest to trim its filesystems (default: 240)')
+    parser.add_argument('--trim-settle', dest='trim_settle', action='store', type=float, default=0, help='after trimming poll the allocated size of the images every N seconds until it stops changing, bounded by --trim-timeout (default: 0, disabled)')
+    parser.add_argument('--freeze', dest='freeze', action='store', choices=['quiesce', 'explicit', 'none'], default='quiesce', help='quiesce: libvirt freezes the guest filesystems while it creates the snapshot, explicit: create the overlays first and freeze only around the snapshot, always used by the bitmap engine, none: crash consistent snapshots without the guest agent (default: quiesce)')
+    parser.add_argument('--freeze-mountpoints', dest='freeze_mountpoints', action='store', default='', help='comma separated mountpoints to freeze with --freeze explicit and the bitmap engine, a list in --domain-config (default: all)')
+    parser.add_argument('--freeze-limit', dest='freeze_limit', action='store', type=float, default=0, help='seconds the guest filesystems may be frozen, longer freezes print a warning and are handled by --freeze-policy (default: 0, no limit)')
+    parser.add_argument('--freeze-policy', dest='freeze_policy', action='store', choices=['warn', 'retry', 'unquiesced'], default='warn', help='when freezing takes longer than --freeze-limit with --freeze explicit or the bitmap engine, retry: thaw and freeze again up to --freeze-retries times, then fail, unquiesced: same, then continue without freezing (default: warn)')
+    parser.add_argument('--freeze-retries', dest='freeze_retries', action='store', type=int, default=2, help='number of retries for --freeze-policy retry and unquiesced, %d seconds apart (default: 2)' % (FREEZE_RETRY_DELAY))
+    parser.add_argument('--jobs', dest='jobs', action='store', type=int, default=1, help='number of domains to backup concurrently (default: 1)')
+    parser.add_argument('--bandwidth', dest='bandwidth', action='store', type=int, default=0, help='MiB/s limit of every qemu-img convert and commit and virsh blockcommit, not applied to --copy and the bitmap engine (default: 0, unlimited)')
+    parser.add_argument('--total-bandwidth', dest='total_bandwidth', action='store', type=int, default=0, help='MiB/s limit of all concurrent domains together, split into --jobs equal shares, further processes wait for a share (default: 0, unlimited)')
+    parser.add_argument('--throttle-hours', dest='throttle_hours', action='store', default='', help='apply the bandwidth limits only from hour to hour of the day, e.g. 7-19 or 22-6 (default: always)')
+    parser.add_argument('--ionice', dest='ionice', action='store', default='', help='io scheduling class of the qemu-img processes: idle or best-effort:0-7 (default: none)')
+    parser.add_argument('--cgroup', dest='cgroup', action='store', default='', help='cgroup v2 directory to run the qemu-img processes in, e.g. with io.max limits (default: none)')
+    parser.add_argument('--replica', dest='replica', action='store', default='', help='after the backup of a domain mirror its images to ssh://[user@]host[:port]/path, s3://bucket/prefix (needs boto3) or a local path (default: none)')
+    parser.add_argument('--replica-endpoint', dest='replica_endpoint', action='store', default='', help='endpoint URL of an S3 compatible service for --replica s3://... (default: AWS)')
+    parser.add_argument('--preflight', dest='preflight', action='store', choices=['off', 'report', 'abort', 'fit'], default='off', help='estimate the bytes every domain adds to the backup dir and the duration from earlier runs before starting, report: print the estimate, abort: fail if the backup does not fit into the free space or --time-budget, fit: skip the largest domains until it fits (default: off)')
+    parser.add_argument('--preflight-reserve', dest='preflight_reserve', action='store', type=float, default=0, help='GiB of the backup dir to keep free for --preflight (default: 0)')
+    parser.add_argument('--time-budget', dest='time_budget', action='store', type=int, default=0, help='seconds the run may take for --preflight abort and fit (default: 0, no limit)')
+    parser.add_argument('--report', dest='report', action='store', default='', help='write timings, subprocess counts and bytes written per domain and drive as JSON to this file (default: none)')
+    parser.add_argument('--prometheus', dest='prometheus', action='store', default='', help='write the run report in the Prometheus text format to this file, e.g. for the node exporter textfile collector (default: none)')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='print progress information (default: no)')
+    parser.add_argument('--no-checksums', dest='no_checksums', action='store_true', default=False, help='do not hash new backup images, verify hashes them later (default: no)')
+    parser.add_argument('--dedup', dest='dedup', action='store_true', default=False, help='store the data of new base images once in a chunk store in the backup dir, in chunks of the qcow2 cluster size, not with compression, the images share it through reflinks or stay thin until materialized if the filesystem does not support reflinks (default: no)')
+    parser.add_argument('--materialize', dest='materialize', action='store_true', default=False, help='write the data of thin base images of the given domains back from the chunk store and exit (default: no)')
+    parser.add_argument('--rebuild-index', dest='rebuild_index', action='store_true', default=False, help='ignore the image index in the backup dir and rescan all images (default: no)')
+    return parser
 
-    if not lock_acquire('/tmp/qemu-backup.lock'):
-        print("another instance is running")
-        exit(1)
+def check_options(args):
+    # also applied to the options of every domain in --domain-config
+    if args.jobs <= 0:
+        raise ValueError('Number of jobs must be positive.')
+    if args.trim_timeout <= 0:
+        raise ValueError('Trim timeout must be positive.')
+    if args.freeze_limit < 0:
+        raise ValueError('Freeze limit must not be negative.')
+    if args.freeze_retries < 0:
+        raise ValueError('Number of freeze retries must not be negative.')
+    if args.export_jobs < 0:
+        raise ValueError('Number of export jobs must not be negative.')
+    if args.convert_coroutines < 0 or args.convert_coroutines > 16:
+        raise ValueError('Number of coroutines must be between 1 and 16.')
+    if args.bandwidth < 0 or args.total_bandwidth < 0:
+        raise ValueError('Bandwidth must not be negative.')
+    if args.throttle_hours and not re.match(r'^([01]?\d|2[0-3])-([01]?\d|2[0-4])$', args.throttle_hours):
+        raise ValueError('Throttle hours must be given as hour-hour, e.g. 7-19.')
+    if args.ionice and not re.match(r'^(idle|best-effort:[0-7])$', args.ionice):
+        raise ValueError('Unknown io scheduling class: ' + args.ionice)
+    if args.cgroup and not os.path.isfile(args.cgroup + '/cgroup.procs'):
+        raise ValueError('Not a cgroup v2 directory: ' + args.cgroup)
+    if args.dedup and args.compression != 'none':
+        raise ValueError('--dedup cannot be used with compression, compressed clusters are not aligned.')
+    if not args.compression in ['none', 'zlib', 'zstd']:
+        raise ValueError('Unknown compression type: ' + str(args.compression))
+    if not args.freeze in ['quiesce', 'explicit', 'none']:
+        raise ValueError('Unknown freeze mode: ' + str(args.freeze))
+    if not args.freeze_policy in ['warn', 'retry', 'unquiesced']:
+        raise ValueError('Unknown freeze policy: ' + str(args.freeze_policy))
+
+def backup_setup(args):
+    global omit_unsafe, verbose, io_slots
+    check_options(args)
+
+    if args.domain_config:
+        with open(args.domain_config) as f:
+            args.domain_config = json.load(f)
+        if not isinstance(args.domain_config, dict) or not all(isinstance(config, dict) for config in args.domain_config.values()):
+            raise ValueError('The domain config must map domain names to objects of options')
+    else:
+        args.domain_config = {}
+    for vm_name in args.domain_config:
+        domain_args(args, vm_name)
 
     args.intervals = args.intervals.split(',')
     intervals = []
@@ -468,6 +2459,11 @@ if __name__ == '__main__':
         intervals.append(interval)
     args.intervals = intervals
 
+    if args.auto_intervals:
+        if args.interval != '':
+            raise ValueError('--interval cannot be used with --auto-intervals')
+        for interval in args.intervals:
+            interval_boundary(interval[0], datetime.date.today())
     if args.interval == '':
         args.interval = args.intervals[0][0]
 
@@ -477,6 +2473,9 @@ if __name__ == '__main__':
             args.interval = i
             break
         i += 1
+    if not isinstance(args.interval, int):
+        raise ValueError('Unknown interval: ' + args.interval)
+    args.today = datetime.date.today()
 
     domains = []
     for domain in args.domains:
@@ -488,15 +2487,412 @@ if __name__ == '__main__':
         domains.append(domain)
     args.domains = domains
     omit_unsafe = args.omit_unsafe
+    verbose = args.verbose
+    io_slots = threading.BoundedSemaphore(args.jobs)
 
-    init_archive_info(args)
-
-    #connect to hypervisor running on localhost
-    conn = libvirt.open('qemu:///system')
+def materialize(args):
+    for vm in args.domains:
+        for backupset, drives in sorted(archive_info.get(vm[0], {}).items()):
+            for dev in drives:
+                if len(vm) == 1 or dev in vm[1]:
+                    image = "%s/%s.%s.%s.base.img" % (args.backup_dir, vm[0], backupset, dev)
+                    if os.path.exists(image) and chunk_store_materialize(image, args):
+                        print('Materialized ' + Path(image).name)
+    index_save()
 
+def backup_run(args, executor):
+    # drives of the same domain are backed up by the same worker
+    domains = {}
     for vm in args.domains:
-        vm_backup(conn, vm, args)
+        if not vm[0] in domains:
+            domains[vm[0]] = []
+        domains[vm[0]].append(vm)
+
+    failed = []
+    try:
+        selected = list(domains)
+        if args.preflight != 'off':
+            selected = preflight(domains, args)
+            for vm_name in domains:
+                if not vm_name in selected:
+                    report_set(vm_name, 'status', 'skipped')
+                    failed.append(vm_name)
+        futures = {executor.submit(domain_backup, domains[name], args): name for name in selected}
+        for future in concurrent.futures.as_completed(futures):
+            if not future.result():
+                failed.append(futures[future])
+    finally:
+        index_save()
+        run_report['duration'] = time.time() - run_report['start']
+        report_write(args)
+        if not args.dry_run:
+            history_record(args)
+
+    if len(failed) > 0:
+        print('Backup failed for ' + str(len(failed)) + ' of ' + str(len(domains)) + ' domains: ' + ', '.join(sorted(failed)))
+    return failed
 
-    conn.close()
+def inotify_watch(path):
+    # a non blocking inotify descriptor for the files in path
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed: ' + os.strerror(ctypes.get_errno()))
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, 'inotify_add_watch failed: ' + os.strerror(error))
+    return fd
 
-exit(0)
+def inotify_names(fd):
+    # names of the files of the pending events, None for a lost event queue
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return []
+    names = []
+    offset = 0
+    while offset < len(data):
+        # struct inotify_event: int wd, uint32_t mask, cookie, len, char name[len]
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+        name = data[offset+16:offset+16+length].rstrip(b'\0')
+        names.append(None if mask & IN_Q_OVERFLOW else os.fsdecode(name))
+        offset += 16 + length
+    return names
+
+def daemon_watch(daemon, fd):
+    while not daemon['stop'].is_set():
+        if not select.select([fd], [], [], 1)[0]:
+            continue
+        for name in inotify_names(fd):
+            if name is None or name.endswith('.img'):
+                archive_watch['changed'].set()
+
+def daemon_submit(daemon, command, argv, priority, cwd=None):
+    with daemon['cond']:
+        job = { 'id': daemon['next_id'], 'command': command, 'args': argv, 'cwd': cwd, 'priority': priority, 'state': 'queued', 'queued': time.time() }
+        daemon['next_id'] += 1
+        daemon['jobs'][job['id']] = job
+        heapq.heappush(daemon['queue'], (priority, job['id']))
+        daemon['cond'].notify()
+    return job
+
+def daemon_job_view(job):
+    view = dict(job)
+    if job['state'] == 'running':
+        view['progress'] = dict(progress)
+        if job['command'] == 'backup':
+            with report_lock:
+                view['domains'] = dict((vm_name, domain.get('status', 'running')) for vm_name, domain in run_report['domains'].items())
+    return view
+
+def daemon_status(daemon, job_id=None):
+    with daemon['cond']:
+        jobs = list(daemon['jobs'].values()) + list(daemon['finished'])
+        if job_id is not None:
+            for job in jobs:
+                if job['id'] == job_id:
+                    return daemon_job_view(job)
+            raise LookupError('Unknown job: ' + str(job_id))
+        return {
+            'running': [daemon_job_view(job) for job in jobs if job['state'] == 'running'],
+            'queued': sorted([daemon_job_view(job) for job in jobs if job['state'] == 'queued'], key=lambda job: (job['priority'], job['id'])),
+            'finished': [daemon_job_view(job) for job in daemon['finished']],
+            'watching': daemon['watching'],
+            'next_run': daemon['next_run']
+        }
+
+def daemon_request(daemon, request):
+    command = request.get('command')
+    if command == 'status':
+        return daemon_status(daemon, request.get('id'))
+    if command == 'cancel':
+        with daemon['cond']:
+            job = daemon['jobs'].get(request.get('id'))
+            if job is None or job['state'] != 'queued':
+                raise LookupError('No queued job: ' + str(request.get('id')))
+            # the dispatcher skips it when it comes up
+            job.update(state='cancelled', result=1, finished=time.time())
+            del daemon['jobs'][job['id']]
+            daemon['finished'].append(job)
+        return daemon_job_view(job)
+    if command in DAEMON_PRIORITIES:
+        argv = request.get('args', [])
+        if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+            raise ValueError('args must be a list of strings')
+        cwd = request.get('cwd')
+        if cwd is not None and (not isinstance(cwd, str) or not os.path.isabs(cwd)):
+            raise ValueError('cwd must be an absolute path')
+        return daemon_job_view(daemon_submit(daemon, command, argv, int(request.get('priority', DAEMON_PRIORITIES[command])), cwd))
+    raise ValueError('Unknown command: ' + str(command))
+
+def daemon_serve(daemon, server):
+    # requests and responses are one line of JSON each
+    while not daemon['stop'].is_set():
+        if not select.select([server], [], [], 1)[0]:
+            continue
+        conn = server.accept()[0]
+        try:
+            conn.settimeout(10)
+            try:
+                response = daemon_request(daemon, json.loads(conn.makefile('rb').readline(1024 * 1024)))
+            except Exception as e:
+                response = { 'error': str(e) }
+            conn.sendall((json.dumps(response) + '\n').encode())
+        except OSError as e:
+            print('Warning: daemon request failed: ' + str(e))
+        finally:
+            conn.close()
+
+def job_parser_error(message):
+    raise ValueError(message)
+
+def job_parser(parser):
+    # invalid options of a daemon job are reported to the client, argparse
+    # would print them on the stderr of the daemon and exit
+    parser.exit_on_error = False
+    parser.error = job_parser_error
+    return parser
+
+def job_paths(args, job):
+    # relative paths in the options of a job are relative to the working
+    # directory of ctl, the daemon has made its own paths absolute
+    if job.get('cwd') is None:
+        return
+    for name in ['backup_dir', 'output', 'domain_config', 'report', 'prometheus', 'replica']:
+        path = getattr(args, name, '')
+        if isinstance(path, str) and path != '' and not os.path.isabs(path) and not (name == 'replica' and '://' in path):
+            setattr(args, name, os.path.join(job['cwd'], path))
+
+def daemon_run(daemon, job):
+    global verbose, omit_unsafe
+    try:
+        if job['command'] == 'verify':
+            return verify(['--backup-dir', daemon['args'].backup_dir] + job['args'], job)
+        if job['command'] == 'restore':
+            return restore(['--backup-dir', daemon['args'].backup_dir] + job['args'], job)
+        return daemon_backup(daemon, job)
+    finally:
+        # the next job starts with the options of the daemon
+        verbose = daemon['args'].verbose
+        omit_unsafe = daemon['args'].omit_unsafe
+
+def daemon_backup(daemon, job):
+    # backup jobs default to the options of the daemon, scheduled runs use them unchanged
+    args = copy.copy(daemon['args'])
+    if job['args'] is not None:
+        args = job_parser(backup_parser('qemu-backup.py backup')).parse_args(job['args'], args)
+        job_paths(args, job)
+    backup_setup(args)
+    if args.materialize:
+        raise ValueError('--materialize is not supported by the daemon')
+    report_reset()
+    try:
+        init_archive_info(args, [vm[0] for vm in args.domains])
+        return 1 if len(backup_run(args, daemon['executor'])) > 0 else 0
+    finally:
+        # the watcher may see the renames of the run only later
+        if not args.dry_run:
+            archive_watch['changed'].set()
+
+def daemon_dispatch(daemon):
+    # one job at a time, a backup job runs its domains on the workers
+    while True:
+        with daemon['cond']:
+            while not daemon['stop'].is_set() and len(daemon['queue']) == 0:
+                daemon['cond'].wait(1)
+            if daemon['stop'].is_set():
+                return
+            job = daemon['jobs'].get(heapq.heappop(daemon['queue'])[1])
+            if job is None:
+                continue
+            job['state'] = 'running'
+            job['started'] = time.time()
+        if not daemon['watching']:
+            archive_watch['changed'].set()
+        print('Job %d started: %s %s' % (job['id'], job['command'], ' '.join(job['args'] if job['args'] is not None else ['(scheduled)'])))
+        try:
+            result = daemon_run(daemon, job)
+            state = 'done' if result == 0 else 'failed'
+        except (Exception, SystemExit) as e:
+            result = 1
+            state = 'failed'
+            # not 'error', that marks a failed request in the protocol
+            job['failure'] = str(e)
+        print('Job %d %s%s' % (job['id'], state, ': ' + job['failure'] if 'failure' in job else ''))
+        with daemon['cond']:
+            job.update(state=state, result=result, finished=time.time())
+            del daemon['jobs'][job['id']]
+            daemon['finished'].append(job)
+
+def daemon_next_run(schedule, now):
+    # the next of the daily times after now
+    runs = []
+    for at in schedule:
+        run = datetime.datetime.combine(now.date(), at)
+        if run <= now:
+            run += datetime.timedelta(days=1)
+        runs.append(run)
+    return min(runs)
+
+def daemon_schedule(daemon):
+    while True:
+        next_run = daemon_next_run(daemon['schedule'], datetime.datetime.now())
+        daemon['next_run'] = next_run.isoformat()
+        # short waits follow changes of the clock
+        while datetime.datetime.now() < next_run:
+            if daemon['stop'].wait(min((next_run - datetime.datetime.now()).total_seconds(), 60)):
+                return
+        with daemon['cond']:
+            pending = [job for job in daemon['jobs'].values() if job['command'] == 'backup' and job['args'] is None]
+        if len(pending) > 0:
+            print('Scheduled backup skipped, job %d is not finished' % (pending[0]['id']))
+        else:
+            daemon_submit(daemon, 'backup', None, DAEMON_PRIORITIES['backup'])
+
+def daemon(argv):
+    global archive_watch, progress
+    parser = backup_parser('qemu-backup.py daemon')
+    parser.description = 'Backup virtual machines on a schedule and run jobs sent to a UNIX socket.'
+    parser.add_argument('--socket', dest='socket', action='store', default=DAEMON_SOCKET, help='UNIX socket for jobs and status queries, only accessible by the user of the daemon (default: ' + DAEMON_SOCKET + ')')
+    parser.add_argument('--schedule', dest='schedule', action='store', default='01:00', help='comma separated times of day to backup the domains with the other options, none for jobs from the socket only (default: 01:00)')
+    args = parser.parse_args(argv)
+    # backup jobs inherit the options, their paths stay relative to the daemon's directory
+    job_paths(args, { 'cwd': os.getcwd() })
+    schedule = []
+    if args.schedule != 'none':
+        schedule = [datetime.datetime.strptime(at, '%H:%M').time() for at in args.schedule.split(',')]
+    # invalid options fail now and not with the first job
+    backup_setup(copy.copy(args))
+    if args.materialize:
+        raise ValueError('--materialize is not supported by the daemon')
+    if not os.path.isdir(args.backup_dir):
+        raise NotADirectoryError('Backup path not found')
+    if hasattr(sys.stdout, 'reconfigure'):
+        sys.stdout.reconfigure(line_buffering=True)
+
+    lock = lock_acquire(args.socket + '.lock')
+    if lock is None:
+        print('another daemon is running on ' + args.socket)
+        return 1
+    archive_watch = { 'dir': os.path.abspath(args.backup_dir), 'changed': threading.Event(), 'domains': None }
+    archive_watch['changed'].set()
+    progress = {}
+    daemon = {
+        'args': args, 'schedule': schedule, 'cond': threading.Condition(), 'stop': threading.Event(),
+        'queue': [], 'jobs': {}, 'finished': collections.deque(maxlen=DAEMON_FINISHED_JOBS), 'next_id': 1,
+        'watching': False, 'next_run': None,
+        # the workers keep their libvirt connections between jobs
+        'executor': concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    }
+    fd = None
+    try:
+        fd = inotify_watch(archive_watch['dir'])
+        daemon['watching'] = True
+    except (OSError, AttributeError) as e:
+        print('Warning: cannot watch the backup dir, rescanning before every job: ' + str(e))
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        server.bind(args.socket)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda signum, frame: daemon['stop'].set())
+    threads = [threading.Thread(target=daemon_dispatch, args=(daemon,)), threading.Thread(target=daemon_serve, args=(daemon, server))]
+    if fd is not None:
+        threads.append(threading.Thread(target=daemon_watch, args=(daemon, fd)))
+    if len(schedule) > 0:
+        threads.append(threading.Thread(target=daemon_schedule, args=(daemon,)))
+    for thread in threads:
+        thread.start()
+    print('Listening on ' + args.socket)
+    try:
+        while not daemon['stop'].wait(1):
+            pass
+    finally:
+        # a running job is finished first
+        daemon['stop'].set()
+        for thread in threads:
+            thread.join()
+        daemon['executor'].shutdown()
+        for conn in worker_connections:
+            conn.close()
+        server.close()
+        os.unlink(args.socket)
+        if fd is not None:
+            os.close(fd)
+        index_save()
+        lock_release(lock)
+    return 0
+
+def daemon_send(path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall((json.dumps(request) + '\n').encode())
+        response = json.loads(conn.makefile('rb').readline())
+    if 'error' in response:
+        raise Exception(response['error'])
+    return response
+
+def ctl(argv):
+    parser = argparse.ArgumentParser(prog='qemu-backup.py ctl', description='Send a job or a status query to the daemon.')
+    parser.add_argument('command', choices=['status', 'cancel'] + sorted(DAEMON_PRIORITIES), help='status [ID], cancel ID or a job with the options of the backup, verify or restore command')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='job id or options of the job')
+    parser.add_argument('--socket', dest='socket', action='store', default=DAEMON_SOCKET, help='UNIX socket of the daemon (default: ' + DAEMON_SOCKET + ')')
+    parser.add_argument('--priority', dest='priority', action='store', type=int, default=None, help='priority of the job, lower runs first (default: restore 0, backup 10, verify 20)')
+    parser.add_argument('--wait', dest='wait', action='store_true', default=False, help='wait until the job has finished, the exit status is its result (default: no)')
+    args = parser.parse_args(argv)
+
+    request = { 'command': args.command }
+    if args.command in ['status', 'cancel']:
+        if len(args.args) > 0:
+            request['id'] = int(args.args[0])
+    else:
+        # the daemon resolves relative paths in the options against it
+        request['cwd'] = os.getcwd()
+        request['args'] = args.args
+        if args.priority is not None:
+            request['priority'] = args.priority
+
+    response = daemon_send(args.socket, request)
+    while args.wait and args.command in DAEMON_PRIORITIES and response['state'] in ['queued', 'running']:
+        time.sleep(1)
+        response = daemon_send(args.socket, { 'command': 'status', 'id': response['id'] })
+    print(json.dumps(response, indent=2, sort_keys=True))
+    return 1 if args.wait and response.get('result') != 0 else 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        exit(restore(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        exit(verify(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        exit(daemon(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'ctl':
+        exit(ctl(sys.argv[2:]))
+
+    args = backup_parser().parse_args()
+    backup_setup(args)
+    report_reset()
+
+    init_archive_info(args, [vm[0] for vm in args.domains])
+
+    if args.materialize:
+        materialize(args)
+        exit(0)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            failed = backup_run(args, executor)
+    finally:
+        for conn in worker_connections:
+            conn.close()
+    if len(failed) > 0:
+        exit(1)
+    exit(0)
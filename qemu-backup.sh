@@ -1,19 +1,5 @@
 #!/bin/sh
 
-DOM=$(date +%-d)
-DOW=$(date +%-u)
-MON=$(date +%-m)
-
-if [ $DOM -eq 1 -a $MON -eq 1 ]; then
-  qemu-backup.py --interval yearly $*
-fi
-
-if [ $DOM -eq 1 ]; then
-  qemu-backup.py --interval monthly $*
-fi
-
-if [ $DOW -eq 7 ]; then
-  qemu-backup.py --interval weekly $*
-fi
-
-qemu-backup.py $*
+# runs the yearly, monthly and weekly promotions when they are due and
+# the daily backup in a single invocation
+qemu-backup.py --auto-intervals $*
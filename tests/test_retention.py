@@ -0,0 +1,222 @@
+# Tests of the retention planner and the rotation journal. The planner
+# needs no qemu-img, journals are applied with the qemu-img stand-in of
+# the benchmarks on images in a temporary backup dir.
+
+import argparse
+import copy
+import datetime
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_dir = repo_dir + '/bench/fake'
+
+try:
+    import libvirt
+except ImportError:
+    sys.path.insert(0, fake_dir)
+spec = importlib.util.spec_from_file_location('qemu_backup', repo_dir + '/qemu-backup.py')
+qemu_backup = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(qemu_backup)
+
+INTERVALS = [['daily', 3], ['weekly', 2], ['monthly', 2]]
+
+def image_name(nr, interval_name, i):
+    return 'vm.b001.vda.%s.%s.%d.img' % (nr, interval_name, i)
+
+def layout(counts):
+    # images of the intervals from the oldest to the newest, every image
+    # is backed by the one before it
+    images = { 'base': [] }
+    backing_files = {}
+    backing_file = 'vm.b001.vda.base.img'
+    nr = 0
+    for interval_name, count in counts:
+        images[interval_name] = {}
+        for i in range(count - 1, -1, -1):
+            nr += 1
+            filename = image_name('i%05d' % (nr), interval_name, i)
+            images[interval_name][i] = filename
+            backing_files[filename] = backing_file
+            backing_file = filename
+    return images, backing_files
+
+def plan(counts, steps):
+    images, backing_files = layout(counts)
+    return qemu_backup.plan_retention('vm', 'b001', 'vda', images, backing_files, steps, INTERVALS)
+
+class PlanRetentionTest(unittest.TestCase):
+
+    def assertRenamesOrdered(self, ops, counts):
+        # no rename may overwrite an image that is still to be moved
+        names = set(filename for filenames in layout(counts)[0].values() if isinstance(filenames, dict) for filename in filenames.values())
+        for op in ops:
+            if op[0] == 'unlink':
+                names.remove(op[1])
+            elif op[0] == 'rename':
+                self.assertNotIn(op[2], names)
+                names.remove(op[1])
+                names.add(op[2])
+
+    def test_rotate(self):
+        ops, new_images = plan([('daily', 2)], [('rotate', 0)])
+        # daily.1 is moved away before daily.0 takes its name
+        self.assertEqual(ops, [
+            ['rename', image_name('i00001', 'daily', 1), image_name('i00001', 'daily', 2)],
+            ['rename', image_name('i00002', 'daily', 0), image_name('i00002', 'daily', 1)],
+            ['rebase', image_name('i00002', 'daily', 1), image_name('i00001', 'daily', 2)]
+        ])
+        self.assertEqual(new_images['daily'], { 1: image_name('i00002', 'daily', 1), 2: image_name('i00001', 'daily', 2) })
+
+    def test_merge(self):
+        # a full interval merges its two oldest images
+        counts = [('monthly', 1), ('weekly', 2), ('daily', 3)]
+        ops, new_images = plan(counts, [('rotate', 0)])
+        self.assertEqual(ops, [
+            ['commit', image_name('i00004', 'daily', 2), image_name('i00005', 'daily', 1)],
+            ['unlink', image_name('i00005', 'daily', 1)],
+            ['rename', image_name('i00006', 'daily', 0), image_name('i00006', 'daily', 1)],
+            ['rename', image_name('i00004', 'daily', 2), image_name('i00004-i00005', 'daily', 2)],
+            ['rebase', image_name('i00006', 'daily', 1), image_name('i00004-i00005', 'daily', 2)]
+        ])
+        self.assertEqual(new_images['daily'], { 1: image_name('i00006', 'daily', 1), 2: image_name('i00004-i00005', 'daily', 2) })
+        self.assertRenamesOrdered(ops, counts)
+
+    def test_promote(self):
+        # the oldest daily becomes weekly.0, the full weekly interval merges first
+        counts = [('monthly', 1), ('weekly', 2), ('daily', 3)]
+        ops, new_images = plan(counts, [('promote', 1)])
+        self.assertEqual(ops, [
+            ['commit', image_name('i00002', 'weekly', 1), image_name('i00003', 'weekly', 0)],
+            ['unlink', image_name('i00003', 'weekly', 0)],
+            ['rename', image_name('i00002', 'weekly', 1), image_name('i00002-i00003', 'weekly', 1)],
+            ['rename', image_name('i00004', 'daily', 2), image_name('i00004', 'weekly', 0)],
+            ['rebase', image_name('i00004', 'weekly', 0), image_name('i00002-i00003', 'weekly', 1)],
+            ['rebase', image_name('i00005', 'daily', 1), image_name('i00004', 'weekly', 0)]
+        ])
+        self.assertEqual(new_images['weekly'], { 1: image_name('i00002-i00003', 'weekly', 1), 0: image_name('i00004', 'weekly', 0) })
+        self.assertEqual(new_images['daily'], { 1: image_name('i00005', 'daily', 1), 0: image_name('i00006', 'daily', 0) })
+
+    def test_promote_without_backup(self):
+        ops, new_images = plan([('daily', 1)], [('promote', 1)])
+        self.assertEqual(ops, [])
+
+    def test_auto_intervals(self):
+        # promotions of all due intervals and the rotation are planned as one
+        counts = [('monthly', 1), ('weekly', 2), ('daily', 3)]
+        ops, new_images = plan(counts, [('promote', 2), ('promote', 1), ('rotate', 0)])
+        self.assertEqual([op for op in ops if op[0] in ['commit', 'unlink']], [])
+        self.assertEqual(new_images, {
+            'monthly': { 1: image_name('i00001', 'monthly', 1), 0: image_name('i00002', 'monthly', 0) },
+            'weekly': { 1: image_name('i00003', 'weekly', 1), 0: image_name('i00004', 'weekly', 0) },
+            'daily': { 2: image_name('i00005', 'daily', 2), 1: image_name('i00006', 'daily', 1) }
+        })
+        self.assertEqual(ops[0], ['rename', image_name('i00001', 'monthly', 0), image_name('i00001', 'monthly', 1)])
+        self.assertRenamesOrdered(ops, counts)
+        self.assertEqual(len([op for op in ops if op[0] == 'rebase']), 5)
+
+    def test_rename_cycle(self):
+        # two images with swapped indexes cannot be renamed one after the other
+        images = { 'daily': { 0: image_name('i00001', 'daily', 1), 1: image_name('i00001', 'daily', 0) } }
+        backing_files = { image_name('i00001', 'daily', 1): 'vm.b001.vda.base.img', image_name('i00001', 'daily', 0): 'vm.b001.vda.base.img' }
+        with self.assertRaisesRegex(Exception, 'Cannot order renames'):
+            qemu_backup.plan_retention('vm', 'b001', 'vda', images, backing_files, [], INTERVALS)
+
+class BackupStepsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backup_dir = tempfile.mkdtemp(prefix='qemu-backup-test.')
+        self.args = argparse.Namespace(backup_dir=self.backup_dir, auto_intervals=True, intervals=INTERVALS, today=datetime.date(2026, 11, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.backup_dir)
+
+    def test_due_intervals(self):
+        # the first of the month is a sunday, weekly and monthly are due
+        qemu_backup.state_record('vm', ['daily', 'weekly', 'monthly'], self.args, datetime.date(2026, 10, 31))
+        self.assertEqual(qemu_backup.backup_steps('vm', self.args), [('promote', 2), ('promote', 1), ('rotate', 0)])
+        qemu_backup.state_record('vm', ['daily', 'weekly', 'monthly'], self.args)
+        self.assertEqual(qemu_backup.backup_steps('vm', self.args), [('rotate', 0)])
+
+class JournalReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = fake_dir + os.pathsep + self.path
+        self.dirs = []
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        for path in self.dirs:
+            shutil.rmtree(path)
+
+    def backup_dir(self, counts):
+        # images in the format of the qemu-img stand-in
+        backup_dir = tempfile.mkdtemp(prefix='qemu-backup-test.')
+        self.dirs.append(backup_dir)
+        images, backing_files = layout(counts)
+        with open(backup_dir + '/vm.b001.vda.base.img', 'w') as f:
+            json.dump({ 'blocks': ['base'] }, f)
+        for filename, backing_file in backing_files.items():
+            with open(backup_dir + '/' + filename, 'w') as f:
+                json.dump({ 'backing': backing_file, 'blocks': [filename] }, f)
+        args = argparse.Namespace(backup_dir=backup_dir, today=datetime.date(2026, 11, 1), jobs=1,
+            bandwidth=0, total_bandwidth=0, throttle_hours='', ionice='', cgroup='')
+        return args, images, backing_files
+
+    def contents(self, backup_dir):
+        result = {}
+        for name in os.listdir(backup_dir):
+            if name.endswith('.img'):
+                with open(backup_dir + '/' + name) as f:
+                    result[name] = json.load(f)
+        return result
+
+    def journal(self, args, ops):
+        path = qemu_backup.journal_path('vm', 'b001', 'vda', args)
+        journal = { 'domain': 'vm', 'drive': 'vda', 'ops': ops, 'done': 0, 'promoted': ['weekly'], 'date': args.today.isoformat() }
+        qemu_backup.journal_write(path, journal)
+        return path, journal
+
+    def test_interrupted_replay(self):
+        # stopping after any operation, before or after it is marked done,
+        # and replaying the journal gives the same backup dir
+        counts = [('monthly', 1), ('weekly', 2), ('daily', 3)]
+        steps = [('promote', 1), ('rotate', 0)]
+        args, images, backing_files = self.backup_dir(counts)
+        ops = qemu_backup.plan_retention('vm', 'b001', 'vda', images, backing_files, steps, INTERVALS)[0]
+        path, journal = self.journal(args, copy.deepcopy(ops))
+        qemu_backup.apply_plan(path, journal, args)
+        expected = self.contents(args.backup_dir)
+        self.assertFalse(os.path.exists(path))
+        self.assertIn(image_name('i00004', 'weekly', 0), expected)
+        self.assertEqual(expected[image_name('i00002-i00003', 'weekly', 1)]['blocks'], [image_name('i00002', 'weekly', 1), image_name('i00003', 'weekly', 0)])
+
+        for done in range(len(ops)):
+            for marked in [False, True]:
+                args, images, backing_files = self.backup_dir(counts)
+                path, journal = self.journal(args, copy.deepcopy(ops))
+                # the first operations run, the journal is written up to the crash
+                partial = dict(journal, ops=journal['ops'][:done + 1])
+                qemu_backup.apply_plan(path + '.partial', partial, args)
+                journal['done'] = done + 1 if marked else done
+                qemu_backup.journal_write(path, journal)
+                qemu_backup.journal_replay('vm', args)
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(self.contents(args.backup_dir), expected, 'stopped after %s' % (ops[done]))
+
+    def test_failed_replay(self):
+        # a journal that cannot be applied is kept for the next run
+        args, images, backing_files = self.backup_dir([('daily', 2)])
+        path, journal = self.journal(args, [['commit', 'vm.b001.vda.missing.img', image_name('i00002', 'daily', 0)]])
+        with self.assertRaisesRegex(Exception, 'Interrupted rotation not finished'):
+            qemu_backup.journal_replay('vm', args)
+        self.assertTrue(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()